@@ -0,0 +1,16 @@
+"""
+It exposes the ASGI callable as a module-level variable named ``application``.
+
+Set WEBHOOK_ASYNC = True (with WEBHOOK_QUEUE) to route the webhook to the async view when serving through it.
+
+For more information on this file, see
+https://docs.djangoproject.com/en/4.0/howto/deployment/asgi/
+"""
+
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'app.settings')
+
+application = get_asgi_application()
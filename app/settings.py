@@ -40,6 +40,121 @@ PAYMENT_URL = f'{BASE_ADMIN_PATH}/{PAYMENT_PATH}'
 ADMINS_ = []
 DEVS = []
 
+# Outbound HTTP: one pooled keep-alive session per process for every Bot API call
+TELEGRAM_API_URL = None  # e.g. 'http://127.0.0.1:8081/bot{0}/{1}' for a local Bot API server
+TELEGRAM_POOL_SIZE = 32
+TELEGRAM_CONNECT_TIMEOUT = 5
+TELEGRAM_READ_TIMEOUT = 30
+TELEGRAM_CONNECT_RETRIES = 2
+
+# Outbound message rate limits (per second, shared by all processes through RUNTIME_DB_PATH).
+# Broadcasts leave RATE_LIMIT_BROADCAST_RESERVE global tokens to interactive replies
+RATE_LIMIT_ENABLED = True
+RATE_LIMIT_GLOBAL = 30
+RATE_LIMIT_BROADCAST_RESERVE = 10
+RATE_LIMIT_CHAT = 1
+RATE_LIMIT_CHAT_BURST = 3
+RATE_LIMIT_GROUP = 20 / 60
+RATE_LIMIT_GROUP_BURST = 3
+# A 429 pauses the chat (globally for broadcasts) for retry_after, then the call is sent again up to
+# RETRY_429_ATTEMPTS times. Interactive calls are not held longer than RETRY_429_MAX_WAIT seconds
+RETRY_429_ATTEMPTS = 3
+RETRY_429_MAX_WAIT = 10
+
+
+# Update ingress
+# With WEBHOOK_QUEUE enabled the webhook view only appends the raw update to the queue,
+# `python daemons/consumer.py` drains it.
+
+WEBHOOK_QUEUE = False
+# Async webhook view for app/asgi.py: updates are appended to the queue and acknowledged at once,
+# the consumers handle them. Requires WEBHOOK_QUEUE
+WEBHOOK_ASYNC = False
+# Synchronous webhook only: return the first plain reply of an update as the webhook response body
+# instead of a separate sendMessage call
+WEBHOOK_INLINE_REPLY = False
+UPDATE_QUEUE_PATH = os.path.join(BASE_DIR, 'updates.sqlite3')
+UPDATE_QUEUE_SYNC = 'NORMAL'
+UPDATE_QUEUE_BATCH = 32
+UPDATE_QUEUE_LEASE = 60
+UPDATE_QUEUE_MAX_ATTEMPTS = 5
+UPDATE_QUEUE_POLL_INTERVAL = .05
+
+# Updates of one user are handled in order by the same worker, different users in parallel.
+# Users with a critical update queued (order wizard input) are served first
+DISPATCHER_WORKERS = 4
+
+# Load shedding: once a dispatcher shard holds SHED_DEPTH updates, low priority ones (media, repeated presses
+# within SHED_REPEAT_WINDOW s, callbacks on messages older than SHED_STALE_CALLBACK s) only get SHED_REPLY
+SHED_DEPTH = 50
+SHED_REPEAT_WINDOW = 2
+SHED_STALE_CALLBACK = 60 * 60 * 24
+SHED_REPLY = '⏳ Too many requests, please try again in a moment'
+
+# Redelivered updates are dropped by update_id: in-process LRU of DEDUP_SIZE IDs
+# backed by the last DEDUP_WINDOW IDs persisted in RUNTIME_DB_PATH
+DEDUP_UPDATES = True
+DEDUP_SIZE = 10000
+DEDUP_WINDOW = 100000
+
+# Long polling (manage.py startbot --lp 1), the next offset is checkpointed to POLLING_OFFSET_PATH
+POLLING_OFFSET_PATH = os.path.join(BASE_DIR, 'polling.offset')
+POLLING_LIMIT = 100
+POLLING_TIMEOUT = 20
+POLLING_RETRY_INTERVAL = 3
+
+# manage.py startbot --supervise: WORKER_PROCESSES queue consumers, each owning the user IDs
+# with user_id % WORKER_PROCESSES == index, plus daemons/sender.py. Workers are restarted when they make
+# no progress for WORKER_HEALTH_TIMEOUT s; on stop the sender finishes the post it is broadcasting,
+# so WORKER_DRAIN_TIMEOUT should cover a full broadcast
+WORKER_PROCESSES = 2
+WORKER_HEALTH_TIMEOUT = 30
+WORKER_DRAIN_TIMEOUT = 30
+WORKER_RESTART_DELAY = 1
+
+# Local state shared by the bot processes (metrics, dedup window, rate limits...)
+RUNTIME_DB_PATH = os.path.join(BASE_DIR, 'runtime.sqlite3')
+METRICS_INTERVAL = 10
+VERSION_CHECK_INTERVAL = 1
+
+# In-process cache of User rows. Each read checks the version of the user in RUNTIME_DB_PATH,
+# bumped by every save, so processes handling the same users never act on a stale row
+USER_CACHE_SIZE = 5000
+USER_CACHE_TTL = 300
+# Serialized inline buttons reused by ButtonSet for shop, order history and FAQ keyboards
+KEYBOARD_FRAGMENTS_SIZE = 20000
+
+# Conversation state backend: 'db' (User.state columns), 'memory', 'sqlite' (RUNTIME_DB_PATH)
+# or a Redis protocol URL such as 'redis://127.0.0.1:6379/0'
+STATE_STORAGE = 'db'
+STATE_STORAGE_PREFIX = 'bot:state:'
+STATE_STORAGE_TIMEOUT = 5
+# Wizard states untouched for STATE_TTL seconds are dropped when read, `manage.py expirestates` sweeps them
+STATE_TTL = 60 * 60 * 24
+
+# Log rows are buffered and written in batches by a background thread of each process
+LOG_BATCHED = True
+LOG_BATCH_SIZE = 200
+LOG_FLUSH_INTERVAL = 1
+LOG_BUFFER_SIZE = 10000
+LOG_OVERFLOW = 'drop'  # or 'block' to make handlers wait while the buffer is full
+# Per Log type: 'full', 'sample:N' (keep N% of the rows), 'counter' (only the LogCounter rollups) or 'off'
+LOG_POLICIES = {
+    'COMMAND': 'full',
+    'TEXT': 'full',
+    'REPLY_BUTTON': 'sample:10',
+    'INLINE_BUTTON': 'counter',
+}
+# Every logged event is counted per day, type and content in LogCounter; free text is rolled up
+# by type only. `manage.py rolluplogs` counts the rows logged before the rollups existed
+LOG_ROLLUP_CONTENT = ('COMMAND', 'REPLY_BUTTON', 'INLINE_BUTTON')
+# manage.py archivelogs rolls them up, then moves older logs to LOG_ARCHIVE_DIR/YYYY/MM/YYYY-MM-DD.jsonl.gz
+LOG_RETENTION_DAYS = 30
+LOG_ARCHIVE_DIR = os.path.join(BASE_DIR, 'log_archive')
+LOG_ARCHIVE_CHUNK = 5000
+# The archive export of a user in the admin reads the segments of the last N days (?days=N to change it)
+LOG_ARCHIVE_EXPORT_DAYS = 365
+
 
 # Application definition
 
@@ -95,6 +210,7 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'app.wsgi.application'
+ASGI_APPLICATION = 'app.asgi.application'
 
 
 # Database
@@ -169,6 +285,10 @@ ADMIN_REORDER = [
                 'label': '📜 Logs',
                 'model': 'bot.Log'
             },
+            {
+                'label': '📊 Log counters',
+                'model': 'bot.LogCounter'
+            },
             {
                 'label': '💵 Orders',
                 'model': 'bot.Order'
@@ -16,10 +16,10 @@ from django.contrib import admin
 from django.urls import path
 from django.conf import settings
 
-from bot.views import update, payment
+from bot.views import update, update_async, payment
 
 urlpatterns = [
-    path(settings.WEBHOOK_PATH, update),
+    path(settings.WEBHOOK_PATH, update_async if settings.WEBHOOK_ASYNC else update),
     path(settings.PAYMENT_PATH, payment),
     path('', admin.site.urls),
 ]
@@ -1,11 +1,20 @@
+import csv
+from datetime import timedelta
+from itertools import chain
 from contextlib import suppress
+from django import forms
+from django.conf import settings
 from django.contrib import admin
+from django.urls import path
+from django.http import StreamingHttpResponse
+from django.core.exceptions import PermissionDenied
+from django.utils import timezone
 from django.utils.html import format_html
 from django.contrib.auth.models import User as DjangoUser, Group as DjangoGroup
 from preferences.admin import PreferencesAdmin
-from preferences import preferences
+from bot.prefs import preferences
 
-from bot import models, types, utils, misc
+from bot import models, types, utils, misc, archive, texts
 
 admin.site.site_header = admin.site.site_title = 'Bot administration'
 admin.site.site_url = ''
@@ -16,7 +25,7 @@ admin.site.enable_nav_sidebar = False
 
 
 class UserAdmin(admin.ModelAdmin):
-    list_display = ['created', 'user_id', 'username_custom', 'first_name', 'last_name', 'service_fee', 'is_banned']
+    list_display = ['created', 'user_id', 'username_custom', 'first_name', 'last_name', 'service_fee', 'is_banned', 'archive_custom']
     list_editable = ['is_banned', 'service_fee']
     list_filter = ['is_banned']
     list_display_links = None
@@ -30,6 +39,10 @@ class UserAdmin(admin.ModelAdmin):
             return '-'
     username_custom.short_description = '@username'
 
+    def archive_custom(self, obj):
+        return format_html(f'<a href="/bot/log/archive/{obj.user_id}/">CSV</a>')
+    archive_custom.short_description = 'Archived logs'
+
     def has_add_permission(self, *args, **kwargs):
         return False
 
@@ -55,6 +68,46 @@ class LogAdmin(admin.ModelAdmin):
             return '-'
     user_custom.short_description = 'User ID'
 
+    def get_urls(self):
+        return [path('archive/<int:user_id>/', self.admin_site.admin_view(self.archive_view))] + super().get_urls()
+
+    def archive_view(self, request, user_id):
+        if not self.has_view_permission(request):
+            raise PermissionDenied
+        days = settings.LOG_ARCHIVE_EXPORT_DAYS
+        with suppress(ValueError):
+            days = int(request.GET.get('days', days))
+        since = timezone.now().date() - timedelta(days=days)
+
+        class Echo:
+            @staticmethod
+            def write(value):
+                return value
+        writer = csv.writer(Echo())
+        rows = chain([['created', 'user_id', 'type', 'content']],
+                     ([row['created'], row['user_id'], row['type'], row['content']] for row in archive.read_user_logs(user_id, since)))
+        response = StreamingHttpResponse((writer.writerow(row) for row in rows), content_type='text/csv')
+        response['Content-Disposition'] = f'attachment; filename="logs_{user_id}.csv"'
+        return response
+
+    def has_add_permission(self, *args, **kwargs):
+        return False
+
+    def has_change_permission(self, *args, **kwargs):
+        return False
+
+    def has_delete_permission(self, *args, **kwargs):
+        return False
+
+
+class LogCounterAdmin(admin.ModelAdmin):
+    list_display = ['day', 'type', 'content', 'count']
+    list_display_links = None
+
+    date_hierarchy = 'day'
+    search_fields = ['content']
+    list_filter = ['type']
+
     def has_add_permission(self, *args, **kwargs):
         return False
 
@@ -213,8 +266,27 @@ class SettingsAdmin(PreferencesAdmin):
         return False
 
 
+class TextsForm(forms.ModelForm):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        for name, context in texts.CONTEXTS.items():
+            if name in self.fields:
+                self.fields[name].help_text = 'Placeholders: ' + ', '.join(f'{{{x}}}' for x in context)
+
+    def clean(self):
+        cleaned_data = super().clean()
+        for name in texts.CONTEXTS:
+            if cleaned_data.get(name) is not None:
+                try:
+                    texts.compile_text(name, cleaned_data[name])
+                except ValueError as e:
+                    self.add_error(name, str(e))
+        return cleaned_data
+
+
 class TextsAdmin(PreferencesAdmin):
     change_form_template = 'admin/text_change_form.html'
+    form = TextsForm
 
     fieldsets = [
         ('Texts', {'fields': [
@@ -333,6 +405,7 @@ class PostAdmin(admin.ModelAdmin):
 
 admin.site.register(models.User, UserAdmin)
 admin.site.register(models.Log, LogAdmin)
+admin.site.register(models.LogCounter, LogCounterAdmin)
 admin.site.register(models.Order, OrderAdmin)
 admin.site.register(models.Payment, PaymentAdmin)
 admin.site.register(models.Country, CountryAdmin)
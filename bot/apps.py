@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class BotConfig(AppConfig):
     name = 'bot'
     verbose_name = 'Bot'
+
+    def ready(self):
+        # noinspection PyUnresolvedReferences
+        from bot import signals
@@ -0,0 +1,105 @@
+import os
+import gzip
+import json
+from collections import Counter
+from datetime import date, datetime
+from django.conf import settings
+from django.db import transaction
+from bot import models
+from bot.logwriter import rollup_key, rollup_mark, save_counts
+
+FIELDS = ('id', 'created', 'user__user_id', 'type', 'content')
+
+
+def segment_path(day: date, root=None) -> str:
+    return os.path.join(root or settings.LOG_ARCHIVE_DIR, f'{day:%Y}', f'{day:%m}', f'{day:%Y-%m-%d}.jsonl.gz')
+
+
+def segments(root=None) -> list:
+    """
+    Archive files, newest day first
+    """
+    root = root or settings.LOG_ARCHIVE_DIR
+    paths = []
+    for directory, _, files in os.walk(root):
+        paths.extend(os.path.join(directory, name) for name in files if name.endswith('.jsonl.gz'))
+    return sorted(paths, key=os.path.basename, reverse=True)
+
+
+def segment_day(path) -> date:
+    return date.fromisoformat(os.path.basename(path)[:10])
+
+
+def append(path, lines: list):
+    """
+    Add a gzip member to the segment and sync it before the rows are deleted from the table
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'ab') as file:
+        file.write(gzip.compress(''.join(lines).encode()))
+        file.flush()
+        os.fsync(file.fileno())
+
+
+def rollup_logs(chunk=None) -> int:
+    """
+    Count the Log rows written before the log writer started filling LogCounter, resumable by row ID
+    """
+    chunk = chunk or settings.LOG_ARCHIVE_CHUNK
+    mark = rollup_mark()
+    counted = 0
+    while True:
+        rows = list(models.Log.objects.filter(id__gt=mark.last_id, id__lte=mark.until_id).order_by('id')
+                    .values_list('id', 'created', 'type', 'content')[:chunk])
+        if not rows:
+            break
+        with transaction.atomic():
+            save_counts(Counter(rollup_key(created.date(), type_, content) for _, created, type_, content in rows))
+            mark.last_id = rows[-1][0]
+            mark.save(update_fields=['last_id'])
+        counted += len(rows)
+    return counted
+
+
+def archive_logs(before: datetime, chunk=None, root=None) -> int:
+    """
+    Move Log rows created before `before` to the day segments, `chunk` rows per transaction.
+    Rows are rolled up first, archived rows are no longer counted
+    """
+    chunk = chunk or settings.LOG_ARCHIVE_CHUNK
+    rollup_logs(chunk)
+    moved = 0
+    while True:
+        rows = list(models.Log.objects.filter(created__lt=before).order_by('id').values_list(*FIELDS)[:chunk])
+        if not rows:
+            return moved
+        days = {}
+        for id_, created, user_id, type_, content in rows:
+            days.setdefault(created.date(), []).append(json.dumps(
+                {'id': id_, 'created': created.isoformat(), 'user_id': user_id, 'type': type_, 'content': content},
+                ensure_ascii=False) + '\n')
+        for day, lines in days.items():
+            append(segment_path(day, root), lines)
+        with transaction.atomic():
+            models.Log.objects.filter(id__in=[row[0] for row in rows]).delete()
+        moved += len(rows)
+
+
+def read_user_logs(user_id, since: date = None, root=None):
+    """
+    Yield the archived rows of a user, newest first, from the segment of `since` on (all by default).
+    A chunk archived again after an interrupted run is skipped by its row ID
+    """
+    user_id = int(user_id)
+    needle = f'"user_id": {user_id},'
+    seen = set()
+    for path in segments(root):
+        if since is not None and segment_day(path) < since:
+            break
+        with gzip.open(path, 'rt', encoding='utf-8') as file:
+            # the substring only skips parsing the lines of other users
+            rows = [row for row in (json.loads(line) for line in file if needle in line) if row['user_id'] == user_id]
+        for row in reversed(rows):
+            if row['id'] not in seen:
+                seen.add(row['id'])
+                yield row
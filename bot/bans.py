@@ -0,0 +1,49 @@
+import threading
+from bot.versions import VersionStamp
+
+
+class BanList:
+    """
+    In-memory set of banned user IDs, so banned traffic is dropped without a query.
+
+    Loaded on first use, updated in place by the User post_save receiver of this process,
+    reloaded when another process bumps the `bans` version.
+    """
+
+    def __init__(self):
+        self.ids = None
+        self.version = None
+        self.stamp = VersionStamp('bans')
+        self.lock = threading.Lock()
+
+    def load(self):
+        from bot.models import User
+        self.ids = frozenset(User.objects.filter(is_banned=True).values_list('user_id', flat=True))
+
+    def is_stale(self) -> bool:
+        return self.ids is None or self.stamp.get() != self.version
+
+    def refresh(self):
+        with self.lock:
+            version = self.stamp.get()
+            if self.ids is None or version != self.version:
+                self.load()
+                self.version = version
+
+    def is_banned(self, user_id) -> bool:
+        if user_id is None:
+            return False
+        if self.is_stale():
+            self.refresh()
+        return user_id in self.ids
+
+    def set(self, user_id, banned):
+        with self.lock:
+            if self.ids is not None:
+                self.ids = self.ids | {user_id} if banned else self.ids - {user_id}
+        self.stamp.bump()
+        # our own bump must not trigger a reload
+        self.version = self.stamp.get()
+
+
+banlist = BanList()
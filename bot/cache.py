@@ -0,0 +1,84 @@
+import time
+import threading
+from collections import OrderedDict
+from django.conf import settings
+from bot import metrics, storage
+
+
+class UserCache:
+    """
+    LRU of User instances with a TTL.
+
+    Every save or delete of a User bumps the version of that user in the runtime SQLite file and each read
+    compares it with the version the entry was loaded at, so a row changed by any process (admin edits,
+    another web worker) is reloaded on its next use.
+    """
+
+    def __init__(self, size=None, ttl=None, path=None):
+        self.size = size or settings.USER_CACHE_SIZE
+        self.ttl = ttl or settings.USER_CACHE_TTL
+        self.path = path or settings.RUNTIME_DB_PATH
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.connection.execute('CREATE TABLE IF NOT EXISTS user_versions (user_id INTEGER PRIMARY KEY, value INTEGER NOT NULL)')
+        metrics.register('user_cache', self.stats)
+
+    @property
+    def connection(self):
+        return storage.connect(self.path)
+
+    def version(self, user_id) -> int:
+        row = self.connection.execute('SELECT value FROM user_versions WHERE user_id = ?', (user_id,)).fetchone()
+        return row[0] if row else 0
+
+    def get(self, user_id) -> tuple:
+        """
+        (cached User or None, version to pass to put() with the User loaded on a miss)
+        """
+        version = self.version(user_id)
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is None or entry[0] < time.monotonic() or entry[1] != version:
+                if entry is not None and entry[1] != version:
+                    self.stale += 1
+                self.misses += 1
+                return None, version
+            self.entries.move_to_end(user_id)
+            self.hits += 1
+            return entry[2], version
+
+    def put(self, user, version):
+        with self.lock:
+            self.entries[user.user_id] = (time.monotonic() + self.ttl, version, user)
+            self.entries.move_to_end(user.user_id)
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def changed(self, user_id, instance=None):
+        """
+        Bump the version of user_id. The entry is kept only if it is `instance` itself (saved by the
+        handler that holds it), at the new version
+        """
+        version = self.connection.execute('INSERT INTO user_versions (user_id, value) VALUES (?, 1) '
+                                          'ON CONFLICT (user_id) DO UPDATE SET value = value + 1 '
+                                          'RETURNING value', (user_id,)).fetchone()[0]
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is None:
+                return
+            if entry[2] is instance:
+                self.entries[user_id] = (entry[0], version, instance)
+            else:
+                del self.entries[user_id]
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'stale': self.stale, 'size': len(self.entries),
+                'hit_rate': round(self.hits / total, 3) if total else 0.}
+
+
+user_cache = UserCache()
+
@@ -0,0 +1,83 @@
+import threading
+from collections import OrderedDict
+from django.conf import settings
+from bot import storage, metrics
+
+
+class Deduplicator:
+    """
+    Drops redelivered updates by update_id.
+
+    Recent IDs are kept in an in-process LRU, backed by a window of the last DEDUP_WINDOW IDs
+    persisted in the runtime SQLite file, so redeliveries are also caught across restarts and processes.
+    """
+
+    def __init__(self, size=None, window=None, path=None):
+        self.size = size or settings.DEDUP_SIZE
+        self.window = window or settings.DEDUP_WINDOW
+        self.path = path or settings.RUNTIME_DB_PATH
+        self.recent = OrderedDict()
+        self.lock = threading.Lock()
+        self.inserts = 0
+        self.connection.execute('CREATE TABLE IF NOT EXISTS seen_updates (update_id INTEGER PRIMARY KEY)')
+
+    @property
+    def connection(self):
+        return storage.connect(self.path)
+
+    def _remember(self, update_id):
+        with self.lock:
+            self.recent[update_id] = None
+            self.recent.move_to_end(update_id)
+            if len(self.recent) > self.size:
+                self.recent.popitem(last=False)
+
+    def _hit(self, update_id):
+        self._remember(update_id)
+        metrics.incr('dedup.hits')
+        return True
+
+    def is_duplicate(self, update_id) -> bool:
+        if update_id is None:
+            return False
+        if update_id in self.recent:
+            return self._hit(update_id)
+        if self.connection.execute('SELECT 1 FROM seen_updates WHERE update_id = ?', (update_id,)).fetchone():
+            return self._hit(update_id)
+        metrics.incr('dedup.misses')
+        return False
+
+    def mark(self, update_id):
+        """
+        Record update_id, return False if it was already recorded
+        """
+        self._remember(update_id)
+        inserted = self.connection.execute('INSERT OR IGNORE INTO seen_updates (update_id) VALUES (?)', (update_id,)).rowcount
+        self.inserts += inserted
+        if self.inserts >= self.window // 10:
+            self.inserts = 0
+            self.connection.execute('DELETE FROM seen_updates WHERE update_id < ?', (update_id - self.window,))
+        return bool(inserted)
+
+    def seen(self, update_id) -> bool:
+        """
+        Check and record update_id in one step
+        """
+        if update_id is None:
+            return False
+        with self.lock:
+            in_recent = update_id in self.recent
+        if in_recent or not self.mark(update_id):
+            return self._hit(update_id)
+        metrics.incr('dedup.misses')
+        return False
+
+
+_deduplicator = None
+
+
+def get_deduplicator() -> Deduplicator:
+    global _deduplicator
+    if _deduplicator is None:
+        _deduplicator = Deduplicator()
+    return _deduplicator
@@ -0,0 +1,194 @@
+import time
+import heapq
+import itertools
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import close_old_connections
+from bot import metrics
+from bot.priority import Priority
+
+# the stop sentinel is served after every queued item, under a key no caller uses
+STOP = Priority.LOW + 1
+STOP_KEY = object()
+
+
+class KeyedQueue:
+    """
+    Items of one key are served in FIFO order. Priority only picks which key goes next: the key
+    holding the most urgent item, then keys of equal priority in turn
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.items = {}
+        self.heap = []
+        self.scheduled = {}
+        self.sequence = itertools.count()
+        self.size = 0
+        self.unfinished = 0
+
+    def qsize(self):
+        return self.size
+
+    def put(self, key, item, priority=Priority.NORMAL):
+        with self.condition:
+            self.items.setdefault(key, deque()).append((priority, item))
+            self.size += 1
+            self.unfinished += 1
+            if key not in self.scheduled or priority < self.scheduled[key][0]:
+                self.schedule(key, priority)
+            self.condition.notify_all()
+
+    def schedule(self, key, priority):
+        # a key has one live heap entry, older ones are skipped by get()
+        entry = self.scheduled[key] = (priority, next(self.sequence))
+        heapq.heappush(self.heap, (*entry, key))
+
+    def get(self):
+        with self.condition:
+            while True:
+                while not self.heap:
+                    self.condition.wait()
+                priority, sequence, key = heapq.heappop(self.heap)
+                if self.scheduled.get(key) == (priority, sequence):
+                    break
+            items = self.items[key]
+            item = items.popleft()[1]
+            self.size -= 1
+            if items:
+                self.schedule(key, min(priority for priority, _ in items))
+            else:
+                del self.items[key], self.scheduled[key]
+            return item
+
+    def task_done(self):
+        with self.condition:
+            self.unfinished -= 1
+            if not self.unfinished:
+                self.condition.notify_all()
+
+    def join(self):
+        with self.condition:
+            while self.unfinished:
+                self.condition.wait()
+
+
+class Shard(threading.Thread):
+    def __init__(self, dispatcher, index):
+        super().__init__(name=f'shard-{index}', daemon=True)
+        self.dispatcher = dispatcher
+        self.index = index
+        self.queue = KeyedQueue()
+        self.processed = 0
+        self.failed = 0
+        self.latency = 0.
+        self.latency_max = 0.
+        self.busy_since = 0.
+
+    def run(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                self.queue.task_done()
+                return
+            submitted, item, done, handler = task
+            close_old_connections()
+            self.busy_since = time.monotonic()
+            # noinspection PyBroadException
+            try:
+                handler(item)
+            except Exception:
+                self.failed += 1
+                self.dispatcher.on_error(item)
+            else:
+                if done is not None:
+                    done(item)
+            finally:
+                self.busy_since = 0.
+                latency = time.monotonic() - submitted
+                self.processed += 1
+                self.latency = latency if self.processed == 1 else self.latency * .9 + latency * .1
+                self.latency_max = max(self.latency_max, latency)
+                self.queue.task_done()
+
+    def stats(self):
+        return {'depth': self.queue.qsize(), 'processed': self.processed, 'failed': self.failed,
+                'latency': round(self.latency, 4), 'latency_max': round(self.latency_max, 4)}
+
+
+class Dispatcher:
+    """
+    Runs `handler` on N worker threads, sharding items by key.
+    Items with the same key (user ID) are always handled by the same shard in submission order,
+    a key with a critical item queued goes ahead of the other keys of its shard.
+    """
+
+    def __init__(self, handler, workers=None, on_error=None, on_shed=None, name='dispatcher'):
+        self.name = name
+        self.handler = handler
+        self.on_error = on_error or (lambda item: None)
+        self.on_shed = on_shed or (lambda item: None)
+        self.shards = [Shard(self, i) for i in range(workers or settings.DISPATCHER_WORKERS)]
+        # shed replies must not wait behind the backlog that caused them, nor block the caller
+        self.shedder = ThreadPoolExecutor(1, thread_name_prefix=f'{name}-shed')
+        metrics.register(name, self.stats)
+
+    def start(self):
+        for shard in self.shards:
+            shard.start()
+        return self
+
+    def submit(self, key, item, done=None, priority=Priority.NORMAL):
+        """
+        Queue item on the shard of key. Once that shard holds SHED_DEPTH items, low priority items are
+        answered by `on_shed` at once instead of being queued; return False in that case
+        """
+        shard = self.shards[hash(key) % len(self.shards)]
+        if priority >= Priority.LOW and shard.queue.qsize() >= settings.SHED_DEPTH:
+            metrics.incr(f'{self.name}.shed')
+            self.shedder.submit(self.shed, item, done)
+            return False
+        shard.queue.put(key, (time.monotonic(), item, done, self.handler), priority)
+        return True
+
+    def shed(self, item, done):
+        # noinspection PyBroadException
+        try:
+            self.on_shed(item)
+        except Exception:
+            self.on_error(item)
+        else:
+            if done is not None:
+                done(item)
+
+    def depth(self):
+        return sum(shard.queue.qsize() for shard in self.shards)
+
+    def join(self):
+        for shard in self.shards:
+            shard.queue.join()
+
+    def stop(self):
+        for shard in self.shards:
+            shard.queue.put(STOP_KEY, None, STOP)
+        for shard in self.shards:
+            shard.join()
+        self.shedder.shutdown()
+
+    def is_alive(self):
+        return all(shard.is_alive() for shard in self.shards)
+
+    def is_stalled(self, timeout) -> bool:
+        """
+        True if a shard has been handling the same item for more than `timeout` seconds
+        """
+        now = time.monotonic()
+        return any(shard.busy_since and now - shard.busy_since > timeout for shard in self.shards)
+
+    def stats(self):
+        data = {'depth': self.depth()}
+        for shard in self.shards:
+            data.update({f'{shard.index}.{key}': value for key, value in shard.stats().items()})
+        return data
@@ -0,0 +1,139 @@
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, NamedTuple, Union
+from django.conf import settings
+from bot.prefs import preferences
+from bot import metrics, state_storage
+from bot.state_storage import TIMESTAMP
+from bot.utils import answer
+
+
+class Step(NamedTuple):
+    """
+    Input expected in a state: stored under `field`, then the wizard moves to `next`
+    (a state, a callable of the state data returning one, or None to finish).
+    `clean` converts the input and raises ValueError to reject it with the `error` text.
+    Button steps only accept input passed from a callback handler.
+    """
+    field: str
+    next: Union[str, Callable[[dict], str], None]
+    clean: Callable[[Any], Any] = str
+    error: str = 'wrong_format'
+    button: bool = False
+
+
+class ActiveUsers:
+    """
+    IDs of the users in a wizard of this process, so the dispatcher serves their input first.
+    Updated by the wizard transitions; an entry left by a reset outside the wizard expires with the state
+    """
+
+    def __init__(self, size=10000):
+        self.size = size
+        self.deadlines = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, user_id, ttl):
+        with self.lock:
+            self.deadlines.pop(user_id, None)
+            self.deadlines[user_id] = time.time() + ttl
+            if len(self.deadlines) > self.size:
+                self.deadlines.popitem(last=False)
+
+    def discard(self, user_id):
+        with self.lock:
+            self.deadlines.pop(user_id, None)
+
+    def __contains__(self, user_id):
+        return self.deadlines.get(user_id, 0) > time.time()
+
+
+active_users = ActiveUsers()
+
+
+class Wizard:
+    """
+    Finite state machine over the conversation state of a user.
+
+    `steps` maps each state to its Step, `prompts` maps a state to a Texts attribute name or to
+    a callable(message, user, data) sent when the state is entered. Every transition is a single
+    state storage write; states untouched for STATE_TTL seconds are dropped.
+    """
+
+    def __init__(self, name, steps: dict, prompts: dict, finish: Callable, ttl=None):
+        self.name = name
+        self.steps = steps
+        self.prompts = prompts
+        self.finish = finish
+        self.ttl = ttl or settings.STATE_TTL
+        for state, step in steps.items():
+            if state not in prompts:
+                raise ValueError(f'{name}: no prompt for state {state!r}')
+            if isinstance(step.next, str) and step.next not in steps:
+                raise ValueError(f'{name}: unknown transition {state!r} -> {step.next!r}')
+
+    def current(self, user) -> tuple:
+        """
+        (state, data) of the user if they are in this wizard, else (None, {})
+        """
+        storage = state_storage.get_storage()
+        state, data = storage.get(user)
+        if state not in self.steps:
+            active_users.discard(user.user_id)
+            return None, {}
+        started = data.get(TIMESTAMP, 0)
+        if started < time.time() - self.ttl:
+            storage.reset(user)
+            active_users.discard(user.user_id)
+            metrics.incr(f'{self.name}.expired')
+            return None, {}
+        # the state may have been entered through another process
+        active_users.add(user.user_id, started + self.ttl - time.time())
+        return state, data
+
+    def prompt(self, message, user, state, data):
+        prompt = self.prompts[state]
+        if callable(prompt):
+            prompt(message, user, data)
+        else:
+            answer(message, getattr(preferences.Texts, prompt))
+
+    def start(self, message, user, state=None):
+        state = state or next(iter(self.steps))
+        state_storage.get_storage().set(user, state, {TIMESTAMP: time.time()})
+        active_users.add(user.user_id, self.ttl)
+        self.prompt(message, user, state, {})
+
+    def feed(self, message, user, state, data, value, button=False) -> bool:
+        """
+        Apply `value` to the step of `state`, return False if it was rejected
+        """
+        step = self.steps[state]
+        if step.button != button:
+            self.prompt(message, user, state, data)
+            return False
+        try:
+            value = step.clean(value)
+        except ValueError:
+            answer(message, getattr(preferences.Texts, step.error))
+            return False
+        data = {**data, step.field: value, TIMESTAMP: time.time()}
+        state = step.next(data) if callable(step.next) else step.next
+        storage = state_storage.get_storage()
+        if state is None:
+            storage.reset(user)
+            active_users.discard(user.user_id)
+            data.pop(TIMESTAMP)
+            self.finish(message, user, data)
+        else:
+            storage.set(user, state, data)
+            active_users.add(user.user_id, self.ttl)
+            self.prompt(message, user, state, data)
+        return True
+
+
+def digits(value: str) -> int:
+    if not value.isdigit():
+        raise ValueError(value)
+    return int(value)
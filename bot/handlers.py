@@ -1,6 +1,6 @@
-from preferences import preferences
+from bot.prefs import preferences
 from telebot import types
-from bot import models, utils
+from bot import models, utils, fsm, texts
 from bot.misc import bot
 from bot.utils import answer, ButtonSet
 from bot.types import Log
@@ -20,16 +20,9 @@ def start_handler(message: types.Message, user: models.User):
 def distribute_state_text_handler(message: types.Message, user: models.User):
     if main_text_handler(message, user):
         return
-    state_funcs = {
-        utils.States.ORDER_LOG: order_log,
-        utils.States.ORDER_PASS: order_pass1,
-        utils.States.ORDER_SHOP: order_shop,
-        utils.States.ORDER_PASS2: order_pass2,
-        utils.States.ORDER_AMOUNT: order_amount,
-        utils.States.ORDER_COMMENT: order_comment,
-    }
-    if state_funcs.get(user.state):
-        state_funcs[user.state](message, user)
+    state, data = order_wizard.current(user)
+    if state is not None:
+        order_input(message, user, state, data)
     else:
         else_text_handler(message, user)
 
@@ -89,8 +82,8 @@ def else_text_handler(message, user):
 @utils.logger_middleware(Log.REPLY_BUTTON)
 def send_profile(message: types.Message, user):
     orders = models.Order.objects.filter(user=user)
-    answer(message, preferences.Texts.profile.format(first_launch=user.created.strftime("%d.%m.%Y %H:%M"), orders_qty=orders.count(),
-                                                     total=sum(x.amount for x in orders), fee=user.service_fee if user.service_fee is not None else preferences.Settings.service_fee))
+    answer(message, texts.render('profile', first_launch=user.created.strftime("%d.%m.%Y %H:%M"), orders_qty=orders.count(),
+                                 total=sum(x.amount for x in orders), fee=user.service_fee if user.service_fee is not None else preferences.Settings.service_fee))
 
 
 # noinspection PyUnusedLocal
@@ -119,80 +112,75 @@ def send_help(message: types.Message, user):
     answer(message, preferences.Texts.help, reply_markup=ButtonSet(ButtonSet.INL_HELP))
 
 
-@utils.logger_middleware(Log.TEXT)
-def order_log(message: types.Message, user):
-    user.update_state_data({'log': message.text})
-    user.set_state(utils.States.ORDER_PASS)
-    answer(message, preferences.Texts.order_pass)
-
-
-@utils.logger_middleware(Log.TEXT)
-def order_pass1(message: types.Message, user):
-    user.update_state_data({'pass1': message.text})
-    user.set_state(utils.States.ORDER_SHOP)
+def prompt_order_shop(message: types.Message, user, data):
     buttons = [(x.name, x.id) for x in models.Shop.objects.filter(available=True)]
     answer(message, preferences.Texts.order_shop, ButtonSet(ButtonSet.INL_ORDER_SHOPS, buttons))
 
 
-@utils.logger_middleware(Log.TEXT)
-def order_pass2(message: types.Message, user):
-    user.update_state_data({'pass2': message.text})
-    user.set_state(utils.States.ORDER_AMOUNT)
-    answer(message, preferences.Texts.order_amount)
+def shop_choice(value) -> int:
+    if not models.Shop.objects.filter(id=value, available=True).exists():
+        raise ValueError(value)
+    return int(value)
 
 
-@utils.logger_middleware(Log.TEXT)
-def order_amount(message: types.Message, user):
-    if not message.text.isdigit():
-        answer(message, preferences.Texts.wrong_format)
-        return
-    user.update_state_data({'amount': int(message.text)})
-    user.set_state(utils.States.ORDER_COMMENT)
-    answer(message, preferences.Texts.order_comment)
+def after_shop(data) -> str:
+    if models.Shop.objects.filter(id=data['shop_id'], pass2=True).exists():
+        return utils.States.ORDER_PASS2
+    return utils.States.ORDER_AMOUNT
 
 
-@utils.logger_middleware(Log.TEXT)
-def order_comment(message: types.Message, user):
-    data = user.update_state_data({'comment': message.text})
-    user.reset_state()
+def create_order(message: types.Message, user, data):
     order = models.Order.objects.create(user=user, log=data['log'], pass1=data['pass1'], shop_id=data['shop_id'],
                                         pass2=data.get('pass2'), amount=data['amount'], comment=data['comment'])
     utils.broadcast_to_admins(f'New order: https:///bot/order/{order.id}')
     answer(message, preferences.Texts.order_created, reply_markup=ButtonSet(ButtonSet.START))
 
 
+order_wizard = fsm.Wizard('order_wizard', steps={
+    utils.States.ORDER_LOG: fsm.Step('log', utils.States.ORDER_PASS),
+    utils.States.ORDER_PASS: fsm.Step('pass1', utils.States.ORDER_SHOP),
+    utils.States.ORDER_SHOP: fsm.Step('shop_id', after_shop, clean=shop_choice, button=True),
+    utils.States.ORDER_PASS2: fsm.Step('pass2', utils.States.ORDER_AMOUNT),
+    utils.States.ORDER_AMOUNT: fsm.Step('amount', utils.States.ORDER_COMMENT, clean=fsm.digits),
+    utils.States.ORDER_COMMENT: fsm.Step('comment', None),
+}, prompts={
+    utils.States.ORDER_LOG: 'order_log',
+    utils.States.ORDER_PASS: 'order_pass',
+    utils.States.ORDER_SHOP: prompt_order_shop,
+    utils.States.ORDER_PASS2: 'order_pass2',
+    utils.States.ORDER_AMOUNT: 'order_amount',
+    utils.States.ORDER_COMMENT: 'order_comment',
+}, finish=create_order)
+
+
+@utils.logger_middleware(Log.TEXT)
+def order_input(message: types.Message, user, state, data):
+    order_wizard.feed(message, user, state, data, message.text)
+
+
 # noinspection PyUnusedLocal
 @utils.logger_middleware(Log.INLINE_BUTTON, is_callback=True)
 def add_order_chain_start(message, callback: types.CallbackQuery, user, data):
     # bot.delete_message(message.chat.id, message.message_id)
-    user.set_state(utils.States.ORDER_LOG)
-    answer(message, preferences.Texts.order_log)
+    order_wizard.start(message, user)
     bot.answer_callback_query(callback.id)
 
 
 # noinspection PyUnusedLocal
 @utils.logger_middleware(Log.INLINE_BUTTON, is_callback=True)
 def order_shop(message, callback: types.CallbackQuery, user, data):
-    try:
-        shop = models.Shop.objects.get(id=data)
-    except models.Shop.DoesNotExist:
-        return
-    user.update_state_data({'shop_id': data})
     bot.answer_callback_query(callback.id)
-    if shop.pass2:
-        user.set_state(utils.States.ORDER_PASS2)
-        answer(message, preferences.Texts.order_pass2)
-    else:
-        user.set_state(utils.States.ORDER_AMOUNT)
-        answer(message, preferences.Texts.order_amount)
+    state, state_data = order_wizard.current(user)
+    if state == utils.States.ORDER_SHOP:
+        order_wizard.feed(message, user, state, state_data, data, button=True)
 
 
 # noinspection PyUnusedLocal
 @utils.logger_middleware(Log.INLINE_BUTTON, is_callback=True)
 def orders_history(message, callback: types.CallbackQuery, user, data):
     bot.answer_callback_query(callback.id)
-    buttons = [(preferences.Texts.btn_history_line.format(date=x.created.strftime("%d.%m.%y"), log=x.log, shop=x.shop.name,
-                                                          amount=x.amount, status=utils.status_emoji(x.status)), x.id)
+    buttons = [(texts.render('btn_history_line', date=x.created.strftime("%d.%m.%y"), log=x.log, shop=x.shop.name,
+                             amount=x.amount, status=utils.status_emoji(x.status)), x.id)
                for x in models.Order.objects.filter(user=user).order_by('-created')]
     # answer(message, preferences.Texts.order_history, reply_markup=ButtonSet(ButtonSet.INL_ORDER_HISTORY, buttons))
     bot.edit_message_text(preferences.Texts.order_history, message.chat.id, message.message_id, parse_mode='HTML',
@@ -211,8 +199,8 @@ def order_info(message, callback: types.CallbackQuery, user, data):
     #                                                          amount=order.amount, status=utils.status_emoji(order.status), pass1=order.pass1,
     #                                                          pass2=order.pass2 or '-', comment=order.comment))
     bot.edit_message_text(
-        preferences.Texts.order_full_info.format(
-            date=order.created.strftime("%d.%m.%Y %H:%M"), log=order.log, shop=order.shop.name,
+        texts.render(
+            'order_full_info', date=order.created.strftime("%d.%m.%Y %H:%M"), log=order.log, shop=order.shop.name,
             amount=order.amount, status=utils.status_emoji(order.status), pass1=order.pass1,
             pass2=order.pass2 or '-', comment=order.comment
         ),
@@ -229,7 +217,7 @@ def shop_info(message, callback: types.CallbackQuery, user, data):
     except models.Shop.DoesNotExist:
         return
     bot.answer_callback_query(callback.id)
-    answer(message, preferences.Texts.shop_full_info.format(store=shop.name, country=shop.country.name, limit=shop.limit, qty=shop.quantity, timeframe=shop.timeframe, comment=shop.comment))
+    answer(message, texts.render('shop_full_info', store=shop.name, country=shop.country.name, limit=shop.limit, qty=shop.quantity, timeframe=shop.timeframe, comment=shop.comment))
 
 
 # noinspection PyUnusedLocal
@@ -0,0 +1,161 @@
+import time
+import threading
+import traceback
+from contextlib import suppress
+from django.conf import settings
+from bot import storage
+from bot.dispatcher import Dispatcher
+from bot.dedup import get_deduplicator
+from bot.updates import UpdateView, dispatch
+from bot.priority import classify, shed_reply
+
+
+class UpdateQueue:
+    """
+    Durable local queue of raw webhook bodies.
+
+    Rows are leased on claim and deleted on ack, so an update taken by a crashed worker
+    becomes visible again once its lease expires (at-least-once delivery). Consumers extend the
+    leases of the rows they still hold, and drop redelivered updates already handled by update_id.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or settings.UPDATE_QUEUE_PATH
+        self.connection.execute('CREATE TABLE IF NOT EXISTS updates ('
+                                'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                                'body BLOB NOT NULL, '
+                                'user_id INTEGER, '
+                                'leased_until REAL NOT NULL DEFAULT 0, '
+                                'attempts INTEGER NOT NULL DEFAULT 0)')
+        if 'user_id' not in [row[1] for row in self.connection.execute('PRAGMA table_info(updates)')]:
+            self.connection.execute('ALTER TABLE updates ADD COLUMN user_id INTEGER')
+
+    @property
+    def connection(self):
+        return storage.connect(self.path, settings.UPDATE_QUEUE_SYNC)
+
+    def put(self, body: bytes, user_id=None):
+        self.connection.execute('INSERT INTO updates (body, user_id) VALUES (?, ?)', (body, user_id))
+
+    def claim(self, limit=None, lease=None, shard=(0, 1)):
+        """
+        Lease the oldest available rows whose user ID falls into `shard` = (index, count)
+        """
+        now = time.time()
+        with storage.transaction(self.connection) as conn:
+            rows = conn.execute('SELECT id, body, attempts FROM updates '
+                                'WHERE leased_until <= ? AND ABS(IFNULL(user_id, 0)) % ? = ? ORDER BY id LIMIT ?',
+                                (now, shard[1], shard[0], limit or settings.UPDATE_QUEUE_BATCH)).fetchall()
+            if rows:
+                conn.executemany('UPDATE updates SET leased_until = ?, attempts = attempts + 1 WHERE id = ?',
+                                 [(now + (lease or settings.UPDATE_QUEUE_LEASE), row[0]) for row in rows])
+        return rows
+
+    def extend(self, ids, lease=None):
+        until = time.time() + (lease or settings.UPDATE_QUEUE_LEASE)
+        self.connection.executemany('UPDATE updates SET leased_until = ? WHERE id = ?', [(until, x) for x in ids])
+
+    def ack(self, *ids):
+        self.connection.executemany('DELETE FROM updates WHERE id = ?', [(x,) for x in ids])
+
+    def release(self, *ids):
+        self.connection.executemany('UPDATE updates SET leased_until = 0 WHERE id = ?', [(x,) for x in ids])
+
+    def depth(self):
+        return self.connection.execute('SELECT COUNT(*) FROM updates').fetchone()[0]
+
+
+def report_exception():
+    with suppress(Exception):
+        from bot.misc import bot
+        bot.send_message(settings.DEVS[0], traceback.format_exc())
+
+
+def process_update(view):
+    from bot.handlers import bot
+    if not isinstance(view, UpdateView):
+        view = UpdateView.parse(view)
+    dispatch(bot, view)
+
+
+class Consumer:
+    """
+    Claims leased batches from the queue and fans them out to a per-user ordered dispatcher,
+    acking each row once its update has been handled. Leases of the rows held by the dispatcher
+    are extended every third of UPDATE_QUEUE_LEASE.
+
+    `beat` is the time of the last loop iteration during which no handler ran for longer
+    than WORKER_HEALTH_TIMEOUT, the supervisor restarts the process when it gets old.
+    """
+
+    def __init__(self, queue: UpdateQueue, workers=None, shard=(0, 1)):
+        self.queue = queue
+        self.shard = shard
+        self.dispatcher = Dispatcher(self.handle, workers, on_error=self.on_error, on_shed=self.shed, name='consumer')
+        self.inflight = set()
+        self.lock = threading.Lock()
+        self.beat = time.time()
+
+    @staticmethod
+    def handle(item):
+        id_, view, attempts = item
+        # an update_id is always handled by the shard of its user, so checking here cannot race
+        # with the handling of an earlier copy of the same update
+        if settings.DEDUP_UPDATES and get_deduplicator().is_duplicate(view.update_id):
+            return
+        process_update(view)
+        if settings.DEDUP_UPDATES and view.update_id is not None:
+            get_deduplicator().mark(view.update_id)
+
+    @staticmethod
+    def shed(item):
+        shed_reply(item[1])
+
+    def on_error(self, item):
+        id_, view, attempts = item
+        # the lease runs out and the row is claimed again
+        self.forget(id_)
+        if attempts + 1 >= settings.UPDATE_QUEUE_MAX_ATTEMPTS:
+            report_exception()
+            self.queue.ack(id_)
+
+    def ack(self, item):
+        self.forget(item[0])
+        self.queue.ack(item[0])
+
+    def forget(self, id_):
+        with self.lock:
+            self.inflight.discard(id_)
+
+    def extend_leases(self, stopped):
+        while not stopped.wait(settings.UPDATE_QUEUE_LEASE / 3):
+            with self.lock:
+                ids = list(self.inflight)
+            if ids:
+                self.queue.extend(ids)
+
+    def run(self, stop):
+        self.dispatcher.start()
+        stopped = threading.Event()
+        threading.Thread(target=self.extend_leases, args=(stopped,), name='leases', daemon=True).start()
+        capacity = settings.UPDATE_QUEUE_BATCH * len(self.dispatcher.shards)
+        while not stop.is_set() and self.dispatcher.is_alive():
+            if not self.dispatcher.is_stalled(settings.WORKER_HEALTH_TIMEOUT):
+                self.beat = time.time()
+            rows = self.queue.claim(shard=self.shard) if self.dispatcher.depth() < capacity else None
+            if not rows:
+                time.sleep(settings.UPDATE_QUEUE_POLL_INTERVAL)
+                continue
+            for id_, body, attempts in rows:
+                try:
+                    view = UpdateView.parse(body)
+                except ValueError:
+                    report_exception()
+                    self.queue.ack(id_)
+                    continue
+                with self.lock:
+                    self.inflight.add(id_)
+                self.dispatcher.submit(view.user_id, (id_, view, attempts), done=self.ack, priority=classify(view))
+        # leases are still extended while the dispatcher drains
+        self.dispatcher.stop()
+        stopped.set()
@@ -0,0 +1,86 @@
+import re
+import json
+import threading
+from contextlib import contextmanager
+from telebot.types import JsonSerializable
+
+_local = threading.local()
+
+# Bot API HTML: supported tags, entities, and any other character that is not markup
+HTML_TOKEN = re.compile(r'<(/?)([a-z-]+)(\s[^<>]*)?>|&(?:#\d+|#x[0-9a-f]+|lt|gt|amp|quot);|[^<>&]+', re.I)
+HTML_TAGS = {'b', 'strong', 'i', 'em', 'u', 'ins', 's', 'strike', 'del', 'span', 'tg-spoiler', 'a', 'code', 'pre'}
+
+
+class Slot:
+    def __init__(self):
+        self.reply = None
+        self.chat_id = None
+        self.send = None
+        self.closed = False
+
+
+@contextmanager
+def capture():
+    """
+    Let the first eligible outbound call made by this thread inside the block be returned
+    as the webhook response instead of being sent
+    """
+    slot = _local.slot = Slot()
+    try:
+        yield slot
+    finally:
+        _local.slot = None
+
+
+def is_valid_html(text) -> bool:
+    """
+    True if `text` parses as Bot API HTML: only supported tags, properly nested, and no stray <, > or &.
+    An error in the inline reply is not reported back, such texts are sent directly with their fallback
+    """
+    stack = []
+    position = 0
+    for match in HTML_TOKEN.finditer(text):
+        if match.start() != position:
+            return False
+        position = match.end()
+        closing, tag = match.group(1), (match.group(2) or '').lower()
+        if not tag:
+            continue
+        if tag not in HTML_TAGS:
+            return False
+        if not closing:
+            stack.append(tag)
+        elif not stack or stack.pop() != tag:
+            return False
+    return position == len(text) and not stack
+
+
+def offer(method, params: dict, send) -> bool:
+    """
+    Take the call over as the inline reply if nothing was taken yet, `send` performs it directly if needed later
+    """
+    slot = getattr(_local, 'slot', None)
+    if slot is None or slot.closed:
+        return False
+    slot.closed = True
+    slot.reply = {'method': method}
+    for key, value in params.items():
+        if isinstance(value, JsonSerializable):
+            # telebot omits empty keyboards
+            if value:
+                slot.reply[key] = json.loads(value.to_json())
+        elif value is not None:
+            slot.reply[key] = value
+    slot.chat_id, slot.send = params.get('chat_id'), send
+    return True
+
+
+def flush(chat_id):
+    """
+    A later message to the same chat must not overtake the inline reply: send the reply directly first
+    """
+    slot = getattr(_local, 'slot', None)
+    if slot is None or slot.reply is None or str(slot.chat_id) != str(chat_id):
+        return
+    send, slot.reply, slot.send = slot.send, None, None
+    send()
@@ -0,0 +1,216 @@
+import os
+import atexit
+import random
+import threading
+import traceback
+from collections import Counter
+from django.conf import settings
+from django.db import close_old_connections, transaction, IntegrityError
+from django.db.models import F, Max
+from django.utils import timezone
+from django.core.exceptions import ImproperlyConfigured
+from bot import metrics
+
+
+class LogWriter:
+    """
+    Buffers Log rows in memory and writes them with bulk_create from a background thread,
+    once LOG_BATCH_SIZE rows are queued or LOG_FLUSH_INTERVAL seconds after the first one.
+    Every event is also summed per (day, type, content) in between and added to the LogCounter rollups.
+
+    When LOG_BUFFER_SIZE rows are pending, LOG_OVERFLOW decides: 'drop' the new row or 'block'
+    the caller until the buffer has been written.
+    """
+
+    def __init__(self, batch_size=None, interval=None, capacity=None, overflow=None):
+        self.batch_size = batch_size or settings.LOG_BATCH_SIZE
+        self.interval = interval or settings.LOG_FLUSH_INTERVAL
+        self.capacity = capacity or settings.LOG_BUFFER_SIZE
+        self.overflow = overflow or settings.LOG_OVERFLOW
+        self.condition = threading.Condition()
+        self.rows = []
+        self.counts = Counter()
+        self.thread = None
+        self.stopped = False
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        metrics.register('logs', self.stats)
+
+    def reset(self):
+        """
+        Forget the parent's buffer and flusher thread in a forked child
+        """
+        self.condition = threading.Condition()
+        self.rows = []
+        self.counts = Counter()
+        self.thread = None
+        self.stopped = False
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='log-writer', daemon=True)
+            self.thread.start()
+
+    def write(self, log) -> bool:
+        """
+        Queue an unsaved Log, return False if it was dropped
+        """
+        with self.condition:
+            if self.stopped:
+                log.save()
+                return True
+            self.start()
+            while len(self.rows) >= self.capacity:
+                if self.overflow != 'block':
+                    self.dropped += 1
+                    metrics.incr('logs.dropped')
+                    return False
+                self.condition.notify_all()
+                self.condition.wait()
+            self.rows.append(log)
+            if len(self.rows) >= self.batch_size:
+                self.condition.notify_all()
+        return True
+
+    def count(self, key):
+        with self.condition:
+            if self.stopped:
+                save_counts({key: 1})
+                return
+            self.start()
+            self.counts[key] += 1
+
+    def take(self, wait=True) -> tuple:
+        with self.condition:
+            if wait and not self.stopped and len(self.rows) < self.batch_size:
+                self.condition.wait(self.interval)
+            rows, self.rows = self.rows, []
+            counts, self.counts = self.counts, Counter()
+            self.condition.notify_all()
+        return rows, counts
+
+    def save(self, rows, counts):
+        from bot.models import Log
+        # counted before they are written, so no counted row falls under the rolluplogs boundary
+        # noinspection PyBroadException
+        try:
+            save_counts(counts)
+        except Exception:
+            traceback.print_exc()
+        # noinspection PyBroadException
+        try:
+            if rows:
+                Log.objects.bulk_create(rows, batch_size=self.batch_size)
+        except Exception:
+            self.failed += len(rows)
+            traceback.print_exc()
+        else:
+            self.written += len(rows)
+
+    def run(self):
+        while not self.stopped:
+            rows, counts = self.take()
+            close_old_connections()
+            self.save(rows, counts)
+
+    def flush(self):
+        self.save(*self.take(wait=False))
+
+    def stop(self):
+        """
+        Write what is buffered; later rows are saved synchronously
+        """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(self.interval + 5)
+        self.flush()
+
+    def stats(self):
+        return {'pending': len(self.rows), 'counters': len(self.counts), 'written': self.written,
+                'dropped': self.dropped, 'failed': self.failed}
+
+
+def save_counts(counts: dict):
+    """
+    Add {(day, type, content): n} to LogCounter, one UPDATE per key and an INSERT for new ones
+    """
+    from bot.models import LogCounter
+    if counts and not counting_started:
+        start_counting()
+    for (day, type_, content), value in counts.items():
+        rows = LogCounter.objects.filter(day=day, type=type_, content=content)
+        if rows.update(count=F('count') + value):
+            continue
+        try:
+            with transaction.atomic():
+                LogCounter.objects.create(day=day, type=type_, content=content, count=value)
+        except IntegrityError:
+            rows.update(count=F('count') + value)
+
+
+def rollup_mark():
+    """
+    Progress of manage.py rolluplogs, created with the ID of the last Log row written before counting began
+    """
+    from bot.models import Log, RollupMark
+    mark = RollupMark.objects.filter(name='logs').first()
+    if mark is None:
+        last_id = Log.objects.aggregate(last_id=Max('id'))['last_id'] or 0
+        mark, _ = RollupMark.objects.get_or_create(name='logs', defaults={'until_id': last_id})
+    return mark
+
+
+counting_started = False
+
+
+def start_counting():
+    global counting_started
+    rollup_mark()
+    counting_started = True
+
+
+def parse_policy(type_, policy) -> tuple:
+    """
+    LOG_POLICIES value -> (kind, percent of rows kept)
+    """
+    kind, _, rate = policy.partition(':')
+    if kind == 'sample' and rate.replace('.', '', 1).isdigit() and 0 <= float(rate) <= 100:
+        return kind, float(rate)
+    if kind in ('full', 'counter', 'off') and not rate:
+        return kind, 100. if kind == 'full' else 0.
+    raise ImproperlyConfigured(f'LOG_POLICIES[{type_!r}]: unknown policy {policy!r}')
+
+
+policies = {type_: parse_policy(type_, policy) for type_, policy in settings.LOG_POLICIES.items()}
+log_writer = LogWriter()
+os.register_at_fork(after_in_child=log_writer.reset)
+atexit.register(log_writer.stop)
+
+
+def rollup_key(day, type_, content) -> tuple:
+    return day, type_, (content or '')[:256] if type_ in settings.LOG_ROLLUP_CONTENT else ''
+
+
+def write(log):
+    """
+    Count an unsaved Log in the daily rollups and store it according to the LOG_POLICIES
+    of its type (full by default)
+    """
+    kind, rate = policies.get(log.type, ('full', 100.))
+    if kind == 'off':
+        return
+    key = rollup_key(timezone.now().date(), log.type, log.content)
+    if settings.LOG_BATCHED:
+        log_writer.count(key)
+    else:
+        save_counts({key: 1})
+    if kind != 'full' and random.random() * 100 >= rate:
+        metrics.incr(f'logs.{kind}')
+        return
+    if settings.LOG_BATCHED:
+        log_writer.write(log)
+    else:
+        log.save()
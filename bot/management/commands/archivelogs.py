@@ -0,0 +1,18 @@
+from datetime import timedelta
+from django.conf import settings
+from django.utils import timezone
+from django.core.management.base import BaseCommand
+from bot.archive import archive_logs
+
+
+class Command(BaseCommand):
+    help = 'Roll up, then move logs older than LOG_RETENTION_DAYS to gzip JSONL files in LOG_ARCHIVE_DIR, one per day'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None)
+        parser.add_argument('--chunk', type=int, default=None)
+
+    def handle(self, *args, **options):
+        days = options['days'] if options['days'] is not None else settings.LOG_RETENTION_DAYS
+        moved = archive_logs(timezone.now() - timedelta(days=days), options['chunk'])
+        print(f'{moved} logs archived')
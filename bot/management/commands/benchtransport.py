@@ -0,0 +1,64 @@
+import json
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand
+from telebot import TeleBot, apihelper
+from bot.transport import Transport
+
+RESPONSE = json.dumps({'ok': True, 'result': {'message_id': 1, 'date': 0, 'chat': {'id': 1, 'type': 'private'},
+                                               'text': 'ok'}}).encode()
+
+
+class FakeApiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(RESPONSE)))
+        self.end_headers()
+        self.wfile.write(RESPONSE)
+
+    do_GET = do_POST
+
+    def log_message(self, *args):
+        pass
+
+
+class Command(BaseCommand):
+    help = 'Benchmark Bot API transports against a local fake API server'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--calls', type=int, default=2000)
+        parser.add_argument('--threads', type=int, default=16)
+        parser.add_argument('--rate-limited', action='store_true',
+                            help='also run the pooled transport behind the rate limiter, one chat per call')
+
+    def handle(self, *args, **options):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), FakeApiHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        api_url = f'http://127.0.0.1:{server.server_port}/bot{{0}}/{{1}}'
+        bot = TeleBot('0:bench', threaded=False)
+
+        # the transports are measured on their own: the rate limiter would hold every call to one chat for 1 s
+        variants = [
+            ('one-time sessions', lambda: setattr(apihelper, 'SESSION_TIME_TO_LIVE', 0)),
+            ('telebot default', lambda: setattr(apihelper, 'SESSION_TIME_TO_LIVE', 600)),
+            ('pooled transport', lambda: Transport(pool_size=options['threads'], rate_limited=False).install()),
+        ]
+        if options['rate_limited']:
+            variants.append(('pooled, rate limited', lambda: Transport(pool_size=options['threads'], rate_limited=True).install()))
+        for name, configure in variants:
+            apihelper.CUSTOM_REQUEST_SENDER = None
+            configure()
+            apihelper.API_URL = api_url
+            started = time.perf_counter()
+            with ThreadPoolExecutor(options['threads']) as pool:
+                list(pool.map(lambda i: bot.send_message(i + 1, 'bench'), range(options['calls'])))
+            elapsed = time.perf_counter() - started
+            print(f'{name:>20}: {options["calls"] / elapsed:8.0f} calls/s, {elapsed / options["calls"] * 1000:.2f} ms/call')
+        server.shutdown()
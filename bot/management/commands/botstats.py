@@ -0,0 +1,13 @@
+from datetime import datetime
+from django.core.management.base import BaseCommand
+from bot import metrics
+
+
+class Command(BaseCommand):
+    help = 'Print the metrics last published by the bot processes'
+
+    def handle(self, *args, **options):
+        for process, data in metrics.collect().items():
+            print(f"{process} (pid {data.pop('pid')}, {datetime.fromtimestamp(data.pop('updated')):%Y-%m-%d %H:%M:%S})")
+            for key, value in sorted(data.items()):
+                print(f'    {key}: {value}')
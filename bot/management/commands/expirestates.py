@@ -0,0 +1,12 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from bot import state_storage
+
+
+class Command(BaseCommand):
+    help = 'Drop conversation states untouched for STATE_TTL seconds'
+
+    def handle(self, *args, **options):
+        expired = state_storage.get_storage().expire(time.time() - settings.STATE_TTL)
+        print(f'{expired} expired states dropped')
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from bot.archive import rollup_logs, rollup_mark
+
+
+class Command(BaseCommand):
+    help = 'Count the logs written before the log writer started filling LogCounter, resumable by row ID'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk', type=int, default=None)
+
+    def handle(self, *args, **options):
+        counted = rollup_logs(options['chunk'])
+        print(f'{counted} logs counted, rows up to ID {rollup_mark().until_id} are rolled up')
@@ -1,17 +1,53 @@
 from bot.handlers import bot
-from django.core.management.base import BaseCommand
+from bot import metrics
+from bot.logwriter import log_writer
+from bot.polling import Poller
+from bot.supervisor import Supervisor, run_consumer, run_sender
+from threading import Thread, Event
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
 from app.settings import WEBHOOK_URL
 
 
 class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('--lp')
+        parser.add_argument('--workers', type=int, default=None)
+        parser.add_argument('--supervise', action='store_true')
+        parser.add_argument('--processes', type=int, default=None)
 
     def handle(self, *args, **options):
+        if options['supervise'] and not settings.WEBHOOK_QUEUE:
+            # without the queue the web workers handle every update and the consumers would sit idle
+            raise CommandError('--supervise runs queue consumers: enable WEBHOOK_QUEUE')
         if options['lp']:
             bot.delete_webhook()
-            bot.polling()
+            self.poll(options['workers'])
         else:
             bot.delete_webhook()
             bot.set_webhook(WEBHOOK_URL)
             print(bot.get_webhook_info())
+            if options['supervise']:
+                self.supervise(options['processes'] or settings.WORKER_PROCESSES)
+
+    @staticmethod
+    def supervise(processes):
+        supervisor = Supervisor()
+        for i in range(processes):
+            supervisor.add(f'consumer-{i}', run_consumer, i, processes)
+        supervisor.add('sender', run_sender)
+        supervisor.run()
+
+    @staticmethod
+    def poll(workers):
+        stop = Event()
+        thread = Thread(target=Poller(workers=workers).run, args=(stop,), daemon=True)
+        thread.start()
+        try:
+            while thread.is_alive():
+                metrics.publish('polling')
+                thread.join(settings.METRICS_INTERVAL)
+        except KeyboardInterrupt:
+            stop.set()
+            thread.join()
+        log_writer.stop()
@@ -0,0 +1,85 @@
+import os
+import json
+import time
+import threading
+from contextlib import suppress
+from collections import defaultdict
+from django.conf import settings
+from bot import storage
+
+_lock = threading.Lock()
+_counters = defaultdict(int)
+_gauges = {}
+_providers = {}
+_publisher = None
+
+
+def incr(name, value=1):
+    with _lock:
+        _counters[name] += value
+
+
+def gauge(name, value):
+    _gauges[name] = value
+
+
+def register(name, provider):
+    """
+    Register a callable returning a dict of values collected on snapshot
+    """
+    _providers[name] = provider
+
+
+def snapshot() -> dict:
+    with _lock:
+        data = dict(_counters)
+    data.update(_gauges)
+    for name, provider in list(_providers.items()):
+        data.update({f'{name}.{key}': value for key, value in provider().items()})
+    return data
+
+
+def _connection():
+    conn = storage.connect(settings.RUNTIME_DB_PATH)
+    conn.execute('CREATE TABLE IF NOT EXISTS metrics ('
+                 'process TEXT PRIMARY KEY, pid INTEGER, updated REAL, data TEXT)')
+    return conn
+
+
+def publish(process):
+    _connection().execute('INSERT OR REPLACE INTO metrics (process, pid, updated, data) VALUES (?, ?, ?, ?)',
+                          (process, os.getpid(), time.time(), json.dumps(snapshot())))
+
+
+def collect() -> dict:
+    return {process: {'pid': pid, 'updated': updated, **json.loads(data)}
+            for process, pid, updated, data in _connection().execute('SELECT * FROM metrics ORDER BY process')}
+
+
+def start_publisher(process):
+    """
+    Publish the metrics of this process every METRICS_INTERVAL seconds from a daemon thread,
+    for processes without a loop of their own (web workers, the sender). Started once per process
+    """
+    global _publisher
+    if _publisher is not None:
+        return
+    with _lock:
+        if _publisher is None:
+            _publisher = threading.Thread(target=_publish_forever, args=(process,), name='metrics', daemon=True)
+            _publisher.start()
+
+
+def _publish_forever(process):
+    while True:
+        with suppress(Exception):
+            publish(process)
+        time.sleep(settings.METRICS_INTERVAL)
+
+
+def _reset_publisher():
+    global _publisher
+    _publisher = None
+
+
+os.register_at_fork(after_in_child=_reset_publisher)
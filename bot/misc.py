@@ -1,5 +1,7 @@
 from django.conf import settings
 from telebot import TeleBot
+from bot.transport import transport
 
 
+transport.install()
 bot = TeleBot(settings.TOKEN, threaded=False)
@@ -1,7 +1,6 @@
-import json
 from django.db import models
 from preferences.models import Preferences
-from bot import types
+from bot import types, metrics, state_storage
 
 
 class User(models.Model):
@@ -16,23 +15,68 @@ class User(models.Model):
     state = models.CharField(max_length=256, default=None, null=True)
     state_data = models.TextField(max_length=16384, default=None, null=True)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.take_snapshot()
+        return instance
+
+    def take_snapshot(self, fields=None):
+        """
+        Remember the current values of `fields` (all by default) as the saved ones
+        """
+        concrete = self._meta.concrete_fields if fields is None else [self._meta.get_field(x) for x in fields]
+        loaded = {f.attname: self.__dict__[f.attname] for f in concrete if f.attname in self.__dict__}
+        self._loaded = loaded if fields is None else {**getattr(self, '_loaded', {}), **loaded}
+
+    def get_dirty_fields(self) -> list:
+        loaded = getattr(self, '_loaded', {})
+        return [f.name for f in self._meta.concrete_fields if f.attname not in loaded or loaded[f.attname] != self.__dict__.get(f.attname)]
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        # the fields left out of update_fields are still unsaved
+        self.take_snapshot(kwargs.get('update_fields'))
+
+    def save_dirty(self) -> bool:
+        """
+        Save only the fields changed since the instance was loaded, skip the query if there are none
+        """
+        dirty = self.get_dirty_fields()
+        if not dirty:
+            metrics.incr('user.writes_elided')
+            return False
+        self.save(update_fields=dirty)
+        metrics.incr('user.writes')
+        return True
+
+    def get_state(self):
+        return state_storage.get_storage().get(self)[0]
+
     def set_state(self, state):
-        self.state = state
-        self.save()
+        self.update_state(state)
 
     def reset_state(self):
-        self.state = None
-        self.state_data = None
-        self.save()
+        state_storage.get_storage().reset(self)
 
     def get_state_data(self) -> dict:
-        return json.loads(self.state_data or '{}')
+        return state_storage.get_storage().get(self)[1]
 
     def update_state_data(self, data: dict) -> dict:
-        temp = json.loads(self.state_data or '{}')
+        storage = state_storage.get_storage()
+        state, temp = storage.get(self)
         temp.update(data)
-        self.state_data = json.dumps(temp)
-        self.save()
+        storage.set(self, state, temp)
+        return temp
+
+    def update_state(self, state, data: dict = None) -> dict:
+        """
+        Move to `state` merging `data` into the state data, in a single write
+        """
+        storage = state_storage.get_storage()
+        temp = storage.get(self)[1]
+        temp.update(data or {})
+        storage.set(self, state, temp)
         return temp
 
     def __str__(self):
@@ -61,6 +105,35 @@ class Log(models.Model):
         verbose_name_plural = 'logs'
 
 
+class LogCounter(models.Model):
+    day = models.DateField('Day')
+    type = models.CharField('Type', max_length=16, choices=Log.TYPES)
+    content = models.CharField('Content', max_length=256, blank=True, default='')
+    count = models.PositiveBigIntegerField('Count', default=0)
+
+    def __str__(self):
+        return f'{self.day} {self.type} {self.content}'
+
+    class Meta:
+        ordering = ('-day', '-count')
+        unique_together = ('day', 'type', 'content')
+        verbose_name = 'log counter'
+        verbose_name_plural = 'log counters'
+
+
+class RollupMark(models.Model):
+    """
+    Progress of manage.py rolluplogs: Log rows up to `last_id` are counted, the ones after `until_id`
+    were counted by the log writer
+    """
+    name = models.CharField(max_length=64, unique=True)
+    last_id = models.BigIntegerField(default=0)
+    until_id = models.BigIntegerField()
+
+    def __str__(self):
+        return self.name
+
+
 class Country(models.Model):
     name = models.CharField('Name', max_length=128)
 
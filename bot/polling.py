@@ -0,0 +1,82 @@
+import os
+import time
+import threading
+from django.conf import settings
+from telebot import apihelper
+from bot import metrics
+from bot.misc import bot
+from bot.dispatcher import Dispatcher
+from bot.dedup import get_deduplicator
+from bot.bans import banlist
+from bot.ingress import process_update, report_exception
+from bot.updates import UpdateView
+from bot.priority import classify, shed_reply
+
+
+class Poller:
+    """
+    Long-polling runtime.
+
+    Each getUpdates batch is fanned out to a per-user ordered dispatcher, and the next offset is
+    written to disk only once the whole batch has been handled. Telegram forgets updates as soon as
+    a higher offset is requested, so the next batch is never fetched before that checkpoint.
+    A crash in the middle of a batch replays the uncommitted part of it on restart.
+    """
+
+    def __init__(self, path=None, workers=None):
+        self.path = path or settings.POLLING_OFFSET_PATH
+        self.dispatcher = Dispatcher(process_update, workers, on_error=lambda view: report_exception(),
+                                     on_shed=shed_reply, name='polling')
+        self.offset = self.load_offset()
+
+    def load_offset(self):
+        try:
+            with open(self.path) as f:
+                return int(f.read().strip() or 0) or None
+        except FileNotFoundError:
+            return None
+
+    def save_offset(self, offset):
+        temp = f'{self.path}.tmp'
+        with open(temp, 'w') as f:
+            f.write(str(offset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, self.path)
+        self.offset = offset
+
+    def fetch(self):
+        return apihelper.get_updates(bot.token, self.offset, settings.POLLING_LIMIT, settings.POLLING_TIMEOUT + 5,
+                                     None, settings.POLLING_TIMEOUT)
+
+    @staticmethod
+    def done(view):
+        if settings.DEDUP_UPDATES:
+            get_deduplicator().mark(view.update_id)
+
+    def run(self, stop: threading.Event = None):
+        stop = stop or threading.Event()
+        self.dispatcher.start()
+        while not stop.is_set():
+            # noinspection PyBroadException
+            try:
+                updates = self.fetch()
+            except Exception:
+                report_exception()
+                time.sleep(settings.POLLING_RETRY_INTERVAL)
+                continue
+            if not updates:
+                continue
+            for data in updates:
+                view = UpdateView(data)
+                if banlist.is_banned(view.user_id):
+                    continue
+                # replayed updates are only recorded once handled, so a crash never drops them
+                if settings.DEDUP_UPDATES and get_deduplicator().is_duplicate(view.update_id):
+                    continue
+                self.dispatcher.submit(view.user_id, view, done=self.done, priority=classify(view))
+            self.dispatcher.join()
+            self.save_offset(max(data['update_id'] for data in updates) + 1)
+            metrics.incr('polling.updates', len(updates))
+            metrics.gauge('polling.offset', self.offset)
+        self.dispatcher.stop()
@@ -0,0 +1,73 @@
+import threading
+from types import MappingProxyType
+from preferences import preferences as source
+from bot import metrics
+from bot.versions import VersionStamp
+
+
+class Snapshot:
+    """
+    Read-only copy of the field values of a preferences singleton
+    """
+    __slots__ = ('_values', 'version')
+
+    def __init__(self, instance, version):
+        object.__setattr__(self, '_values', MappingProxyType(
+            {field.attname: field.value_from_object(instance) for field in instance._meta.concrete_fields}))
+        object.__setattr__(self, 'version', version)
+
+    def __getattr__(self, name):
+        try:
+            return self._values[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'{name}: preferences snapshots are read-only')
+
+
+class Preferences:
+    """
+    Drop-in for preferences.preferences: Texts and Settings are loaded once per process
+    and reloaded when the `preferences` version is bumped by a save in any process
+    """
+
+    def __init__(self):
+        self.stamp = VersionStamp('preferences')
+        self.lock = threading.Lock()
+        self.version = None
+        self.snapshots = {}
+        self.loads = 0
+        metrics.register('preferences', self.stats)
+
+    def get(self, name) -> Snapshot:
+        version = self.stamp.get()
+        snapshots = self.snapshots
+        if version != self.version or name not in snapshots:
+            with self.lock:
+                if version != self.version:
+                    self.snapshots, self.version = {}, version
+                if name not in self.snapshots:
+                    self.snapshots = {**self.snapshots, name: Snapshot(getattr(source, name), version)}
+                    self.loads += 1
+                snapshots = self.snapshots
+        return snapshots[name]
+
+    # noinspection PyPep8Naming
+    @property
+    def Texts(self):
+        return self.get('Texts')
+
+    # noinspection PyPep8Naming
+    @property
+    def Settings(self):
+        return self.get('Settings')
+
+    def invalidate(self):
+        self.stamp.bump()
+
+    def stats(self):
+        return {'version': self.version, 'loads': self.loads}
+
+
+preferences = Preferences()
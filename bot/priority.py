@@ -0,0 +1,73 @@
+import time
+import threading
+from collections import OrderedDict
+from contextlib import suppress
+from django.conf import settings
+from bot.misc import bot
+from bot.fsm import active_users
+from bot.updates import UpdateView
+from bot.utils import CallbackFuncs, get_callback
+
+
+class Priority:
+    CRITICAL = 0
+    NORMAL = 1
+    LOW = 2
+
+
+CRITICAL_CALLBACKS = (CallbackFuncs.ADD_ORDER, CallbackFuncs.ORDER_SHOP)
+MEDIA = ('photo', 'animation', 'video')
+
+
+class Classifier:
+    """
+    Priority of an update from its UpdateView alone (no DB access).
+
+    Order wizard callbacks and the text of users in a wizard are critical. Media (file ID echo), a repeat of the user's previous
+    text within SHED_REPEAT_WINDOW seconds and callbacks on messages older than SHED_STALE_CALLBACK
+    seconds are low priority, everything else is normal.
+    """
+
+    def __init__(self, size=10000):
+        self.size = size
+        self.last_text = OrderedDict()
+        self.lock = threading.Lock()
+
+    def is_repeated(self, view: UpdateView, now):
+        key = (view.text, view.callback_data)
+        with self.lock:
+            last = self.last_text.pop(view.user_id, None)
+            self.last_text[view.user_id] = (key, now)
+            if len(self.last_text) > self.size:
+                self.last_text.popitem(last=False)
+        return last is not None and last[0] == key and now - last[1] < settings.SHED_REPEAT_WINDOW
+
+    def __call__(self, view: UpdateView):
+        now = time.time()
+        if view.kind == 'callback_query':
+            data = get_callback(view.callback_data or '')
+            if data is not None and data[0] in CRITICAL_CALLBACKS:
+                return Priority.CRITICAL
+            if now - view.message.get('date', now) > settings.SHED_STALE_CALLBACK or self.is_repeated(view, now):
+                return Priority.LOW
+        elif view.kind == 'message':
+            # wizard input, even a value repeated from the previous step
+            if view.text and view.user_id in active_users:
+                return Priority.CRITICAL
+            if any(view.payload.get(x) for x in MEDIA):
+                return Priority.LOW
+            if view.text and self.is_repeated(view, now):
+                return Priority.LOW
+        return Priority.NORMAL
+
+
+classify = Classifier()
+
+
+def shed_reply(view: UpdateView):
+    """
+    Canned answer for a shed update: a callback is answered with SHED_REPLY, anything else is dropped silently
+    """
+    if view.kind == 'callback_query':
+        with suppress(Exception):
+            bot.answer_callback_query(view.payload['id'], settings.SHED_REPLY)
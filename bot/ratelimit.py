@@ -0,0 +1,118 @@
+import time
+import threading
+from contextlib import contextmanager
+from django.conf import settings
+from bot import storage, metrics
+
+LIMITED_METHODS = ('sendMessage', 'sendPhoto', 'sendAnimation', 'sendVideo', 'sendDocument', 'sendMediaGroup',
+                   'copyMessage', 'forwardMessage', 'editMessageText', 'editMessageCaption', 'editMessageMedia')
+
+
+class Lane:
+    INTERACTIVE = 0
+    BROADCAST = 1
+
+
+_local = threading.local()
+
+
+@contextmanager
+def lane(value):
+    """
+    Send the calls made by this thread inside the block through the given lane
+    """
+    previous = getattr(_local, 'lane', Lane.INTERACTIVE)
+    _local.lane = value
+    try:
+        yield
+    finally:
+        _local.lane = previous
+
+
+def current_lane():
+    return getattr(_local, 'lane', Lane.INTERACTIVE)
+
+
+class RateLimiter:
+    """
+    Token buckets shared by every bot process through the runtime SQLite file:
+    a global messages-per-second budget and one bucket per chat.
+
+    Broadcast calls only take global tokens while more than RATE_LIMIT_BROADCAST_RESERVE are left,
+    so interactive replies always find budget during a broadcast.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or settings.RUNTIME_DB_PATH
+        self.acquired = 0
+        self.connection.execute('CREATE TABLE IF NOT EXISTS buckets ('
+                                'key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)')
+
+    @property
+    def connection(self):
+        return storage.connect(self.path)
+
+    @staticmethod
+    def limits(chat_id):
+        if chat_id is not None and str(chat_id).startswith('-'):
+            return settings.RATE_LIMIT_GROUP, settings.RATE_LIMIT_GROUP_BURST
+        return settings.RATE_LIMIT_CHAT, settings.RATE_LIMIT_CHAT_BURST
+
+    def try_acquire(self, chat_id, lane_=Lane.INTERACTIVE) -> float:
+        """
+        Take a token from the global and the chat bucket, or return how long to wait before retrying
+        """
+        now = time.time()
+        buckets = [('global', settings.RATE_LIMIT_GLOBAL, settings.RATE_LIMIT_GLOBAL,
+                    1 + (settings.RATE_LIMIT_BROADCAST_RESERVE if lane_ == Lane.BROADCAST else 0))]
+        if chat_id is not None:
+            buckets.append((f'chat:{chat_id}', *self.limits(chat_id), 1))
+        with storage.transaction(self.connection) as conn:
+            state = dict((key, (tokens, updated)) for key, tokens, updated in conn.execute(
+                f'SELECT key, tokens, updated FROM buckets WHERE key IN ({",".join("?" * len(buckets))})',
+                [x[0] for x in buckets]))
+            wait, tokens = 0., {}
+            for key, rate, burst, need in buckets:
+                value, updated = state.get(key, (burst, now))
+                tokens[key] = value = min(burst, value + (now - updated) * rate)
+                if value < need:
+                    wait = max(wait, (need - value) / rate)
+            if wait:
+                return wait
+            conn.executemany('INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)',
+                             [(key, value - 1, now) for key, value in tokens.items()])
+        self.acquired += 1
+        if self.acquired % 1000 == 0:
+            self.connection.execute('DELETE FROM buckets WHERE key != ? AND updated < ?', ('global', now - 3600))
+        return 0.
+
+    def pause(self, chat_id, seconds):
+        """
+        Empty the chat bucket (the global one if chat_id is None) so that it only refills after `seconds`
+        """
+        key, rate = ('global', settings.RATE_LIMIT_GLOBAL) if chat_id is None else (f'chat:{chat_id}', self.limits(chat_id)[0])
+        self.connection.execute('INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)',
+                                (key, 1 - seconds * rate, time.time()))
+
+    def acquire(self, chat_id, lane_=None):
+        lane_ = current_lane() if lane_ is None else lane_
+        waited = 0.
+        while True:
+            wait = self.try_acquire(chat_id, lane_)
+            if not wait:
+                break
+            wait = min(wait, 1.)
+            time.sleep(wait)
+            waited += wait
+        if waited:
+            metrics.incr(f'ratelimit.waited.{"broadcast" if lane_ == Lane.BROADCAST else "interactive"}', waited)
+
+
+_limiter = None
+
+
+def get_limiter() -> RateLimiter:
+    global _limiter
+    if _limiter is None:
+        _limiter = RateLimiter()
+    return _limiter
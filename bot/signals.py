@@ -0,0 +1,34 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from bot import models
+from bot.cache import user_cache
+from bot.bans import banlist
+from bot.prefs import preferences
+
+
+@receiver(post_save, sender=models.User)
+def user_saved(sender, instance, created, update_fields=None, **kwargs):
+    if update_fields is None or 'is_banned' in update_fields:
+        # the snapshot still holds the values loaded before this save
+        if getattr(instance, '_loaded', {}).get('is_banned', False) != instance.is_banned:
+            # a rolled back ban must not reach the banlist of any process
+            transaction.on_commit(lambda user_id=instance.user_id, banned=instance.is_banned: banlist.set(user_id, banned))
+    if created:
+        return
+    # other processes must not reload the row before the transaction commits
+    transaction.on_commit(lambda: user_cache.changed(instance.user_id, instance))
+
+
+@receiver(post_delete, sender=models.User)
+def user_deleted(sender, instance, **kwargs):
+    if instance.is_banned:
+        transaction.on_commit(lambda: banlist.set(instance.user_id, False))
+    transaction.on_commit(lambda: user_cache.changed(instance.user_id))
+
+
+@receiver(post_save, sender=models.Texts)
+@receiver(post_save, sender=models.Settings)
+def preferences_saved(sender, instance, **kwargs):
+    # other processes must not reload the snapshot before the admin transaction commits
+    transaction.on_commit(preferences.invalidate)
@@ -0,0 +1,236 @@
+import abc
+import json
+import time
+import socket
+import threading
+from urllib.parse import urlparse
+from django.conf import settings
+from django.db.models import JSONField, Q
+from django.db.models.functions import Cast
+from bot import storage
+
+# key of the last write time in the state data, set by bot.fsm
+TIMESTAMP = '_ts'
+
+
+class BaseStorage(abc.ABC):
+    """
+    Conversation state of a user: the current state name and its data dict, written in one operation
+    """
+
+    @abc.abstractmethod
+    def get(self, user) -> tuple:
+        pass
+
+    @abc.abstractmethod
+    def set(self, user, state, data: dict):
+        pass
+
+    def reset(self, user):
+        self.set(user, None, {})
+
+    def expire(self, before: float) -> int:
+        """
+        Drop states last written before the `before` timestamp, return how many were dropped
+        """
+        return 0
+
+
+class DatabaseStorage(BaseStorage):
+    """
+    User.state/User.state_data columns, saved with update_fields
+    """
+
+    def get(self, user):
+        return user.state, json.loads(user.state_data or '{}')
+
+    def set(self, user, state, data):
+        user.state = state
+        user.state_data = json.dumps(data) if data else None
+        user.save_dirty()
+
+    def expire(self, before):
+        from bot.models import User
+        # one conditional UPDATE: a state written meanwhile no longer matches and is kept
+        expired = Q(state_data=None) | ~Q(data__has_key=TIMESTAMP) | Q(**{f'data__{TIMESTAMP}__lt': before})
+        return User.objects.exclude(state=None).annotate(data=Cast('state_data', JSONField())) \
+            .filter(expired).update(state=None, state_data=None)
+
+
+class MemoryStorage(BaseStorage):
+    """
+    Process-local, lost on restart. expire() only sweeps the process calling it, so `manage.py expirestates`
+    does nothing for it: stale states are dropped when the user is next seen (see bot.fsm.Wizard.current)
+    """
+
+    def __init__(self):
+        self.states = {}
+
+    def get(self, user):
+        state, data = self.states.get(user.user_id, (None, '{}'))
+        return state, json.loads(data)
+
+    def set(self, user, state, data):
+        if state is None and not data:
+            self.states.pop(user.user_id, None)
+        else:
+            self.states[user.user_id] = (state, json.dumps(data))
+
+    def expire(self, before):
+        expired = [key for key, (state, data) in self.states.items() if json.loads(data).get(TIMESTAMP, 0) < before]
+        for key in expired:
+            self.states.pop(key, None)
+        return len(expired)
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    Key-value table in the runtime SQLite file, shared by the processes of one host
+    """
+
+    def __init__(self, path=None):
+        self.path = path or settings.RUNTIME_DB_PATH
+        self.connection.execute('CREATE TABLE IF NOT EXISTS states ('
+                                'user_id INTEGER PRIMARY KEY, state TEXT, data TEXT, updated REAL)')
+
+    @property
+    def connection(self):
+        return storage.connect(self.path)
+
+    def get(self, user):
+        row = self.connection.execute('SELECT state, data FROM states WHERE user_id = ?', (user.user_id,)).fetchone()
+        return (row[0], json.loads(row[1] or '{}')) if row else (None, {})
+
+    def set(self, user, state, data):
+        if state is None and not data:
+            self.connection.execute('DELETE FROM states WHERE user_id = ?', (user.user_id,))
+        else:
+            self.connection.execute('INSERT OR REPLACE INTO states (user_id, state, data, updated) VALUES (?, ?, ?, ?)',
+                                    (user.user_id, state, json.dumps(data), time.time()))
+
+    def expire(self, before):
+        return self.connection.execute('DELETE FROM states WHERE updated < ?', (before,)).rowcount
+
+
+class RedisError(Exception):
+    pass
+
+
+class RedisStorage(BaseStorage):
+    """
+    One JSON value per user in any server speaking the Redis protocol (RESP), over a per-thread connection.
+    Values are written with a STATE_TTL expiry, so the server drops abandoned states itself.
+
+    Every connection is authenticated and switched to its database before use. A command that fails on a
+    reused connection (closed by the server meanwhile) is sent once more on a new one: GET, SET and DEL
+    can be repeated safely
+    """
+
+    def __init__(self, url):
+        url = urlparse(url)
+        self.address = (url.hostname or 'localhost', url.port or 6379)
+        self.db = int(url.path.strip('/') or 0)
+        self.username = url.username
+        self.password = url.password
+        self.prefix = settings.STATE_STORAGE_PREFIX
+        self.local = threading.local()
+
+    def connect(self):
+        sock = socket.create_connection(self.address, timeout=settings.STATE_STORAGE_TIMEOUT)
+        self.local.sock, self.local.file = sock, sock.makefile('rb')
+        try:
+            if self.password:
+                self.execute('AUTH', *filter(None, (self.username, self.password)))
+            if self.db:
+                self.execute('SELECT', self.db)
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        sock, self.local.sock = getattr(self.local, 'sock', None), None
+        if sock is not None:
+            self.local.file.close()
+            sock.close()
+
+    def command(self, *args):
+        if getattr(self.local, 'sock', None) is None:
+            self.connect()
+        else:
+            try:
+                return self.execute(*args)
+            except OSError:
+                pass
+            self.connect()
+        return self.execute(*args)
+
+    def execute(self, *args):
+        payload = [f'*{len(args)}\r\n'.encode()]
+        for arg in args:
+            arg = arg if isinstance(arg, bytes) else str(arg).encode()
+            payload.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+        try:
+            self.local.sock.sendall(b''.join(payload))
+            return self.read_reply()
+        except (OSError, ValueError):
+            # the reply stream can no longer be trusted
+            self.close()
+            raise
+
+    def read_reply(self):
+        line = self.local.file.readline()
+        if not line:
+            raise ConnectionError('Connection closed by server')
+        kind, rest = line[:1], line[1:-2]
+        if kind == b'+':
+            return rest.decode()
+        if kind == b'-':
+            raise RedisError(rest.decode())
+        if kind == b':':
+            return int(rest)
+        if kind == b'$':
+            if int(rest) < 0:
+                return
+            data = self.local.file.read(int(rest) + 2)
+            return data[:-2]
+        if kind == b'*':
+            return [self.read_reply() for _ in range(int(rest))] if int(rest) >= 0 else None
+        raise ConnectionError(f'Unexpected reply {line!r}')
+
+    def key(self, user):
+        return f'{self.prefix}{user.user_id}'
+
+    def get(self, user):
+        value = self.command('GET', self.key(user))
+        if value is None:
+            return None, {}
+        value = json.loads(value)
+        return value['state'], value['data']
+
+    def set(self, user, state, data):
+        if state is None and not data:
+            self.command('DEL', self.key(user))
+        else:
+            self.command('SET', self.key(user), json.dumps({'state': state, 'data': data}), 'EX', settings.STATE_TTL)
+
+
+def create_storage(name) -> BaseStorage:
+    if name == 'db':
+        return DatabaseStorage()
+    if name == 'memory':
+        return MemoryStorage()
+    if name == 'sqlite':
+        return SQLiteStorage()
+    if name.startswith('redis://'):
+        return RedisStorage(name)
+    raise ValueError(f'Unknown state storage {name!r}')
+
+
+_storage = None
+
+
+def get_storage() -> BaseStorage:
+    global _storage
+    if _storage is None:
+        _storage = create_storage(settings.STATE_STORAGE)
+    return _storage
@@ -0,0 +1,35 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+_local = threading.local()
+
+
+def connect(path, synchronous='NORMAL'):
+    """
+    Per-thread (and per-process) autocommit connection to a local SQLite file in WAL mode
+    """
+    connections = getattr(_local, 'connections', None)
+    if connections is None or _local.pid != os.getpid():
+        connections = _local.connections = {}
+        _local.pid = os.getpid()
+    conn = connections.get(path)
+    if conn is None:
+        conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(f'PRAGMA synchronous={synchronous}')
+        connections[path] = conn
+    return conn
+
+
+@contextmanager
+def transaction(conn):
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    else:
+        conn.execute('COMMIT')
@@ -0,0 +1,113 @@
+import os
+import time
+import signal
+import runpy
+import threading
+import multiprocessing
+from django import db
+from django.conf import settings
+from bot import metrics
+from bot.logwriter import log_writer
+
+# workers inherit the configured Django setup of the supervisor
+context = multiprocessing.get_context('fork')
+
+
+class Worker:
+    def __init__(self, name, target, *args):
+        self.name = name
+        self.target = target
+        self.args = args
+        self.heartbeat = context.Value('d', 0.)
+        self.process = None
+        self.restarts = 0
+
+    def start(self):
+        self.heartbeat.value = time.time()
+        self.process = context.Process(target=self.target, args=(*self.args, self.heartbeat), name=self.name)
+        self.process.start()
+
+    def is_alive(self):
+        return self.process is not None and self.process.is_alive()
+
+    def is_healthy(self):
+        return time.time() - self.heartbeat.value < settings.WORKER_HEALTH_TIMEOUT
+
+
+class Supervisor:
+    """
+    Runs worker processes, restarts them when they exit or stop sending heartbeats,
+    and on SIGTERM/SIGINT asks them to drain and waits up to WORKER_DRAIN_TIMEOUT
+    """
+
+    def __init__(self):
+        self.workers = []
+        self.stopping = False
+
+    def add(self, name, target, *args):
+        self.workers.append(Worker(name, target, *args))
+
+    def stop(self, *args):
+        self.stopping = True
+
+    def start(self, worker):
+        # children must not share the parent's database connections
+        db.connections.close_all()
+        worker.start()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for worker in self.workers:
+            self.start(worker)
+        while not self.stopping:
+            time.sleep(1)
+            for worker in self.workers:
+                if worker.is_alive() and not worker.is_healthy():
+                    print(f'{worker.name} is not responding, killing pid {worker.process.pid}')
+                    worker.process.kill()
+                    worker.process.join()
+                if not worker.is_alive() and not self.stopping:
+                    print(f'{worker.name} exited with code {worker.process.exitcode}, restarting')
+                    worker.restarts += 1
+                    time.sleep(settings.WORKER_RESTART_DELAY)
+                    self.start(worker)
+        self.drain()
+
+    def drain(self):
+        for worker in self.workers:
+            if worker.is_alive():
+                worker.process.terminate()
+        deadline = time.time() + settings.WORKER_DRAIN_TIMEOUT
+        for worker in self.workers:
+            worker.process.join(max(0., deadline - time.time()))
+            if worker.is_alive():
+                print(f'{worker.name} did not drain in time, killing pid {worker.process.pid}')
+                worker.process.kill()
+                worker.process.join()
+
+
+def run_consumer(index, count, heartbeat):
+    from bot.ingress import UpdateQueue, Consumer
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *args: stop.set())
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    consumer = Consumer(UpdateQueue(), shard=(index, count))
+    thread = threading.Thread(target=consumer.run, args=(stop,), daemon=True)
+    thread.start()
+    published = 0
+    while thread.is_alive():
+        heartbeat.value = consumer.beat
+        if time.time() - published >= settings.METRICS_INTERVAL:
+            metrics.publish(f'consumer-{index}')
+            published = time.time()
+        thread.join(1)
+    log_writer.stop()
+
+
+def run_sender(heartbeat):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # the sender beats once per message sent and, on SIGTERM, finishes the post it is sending
+    runpy.run_path(os.path.join(settings.BASE_DIR, 'daemons', 'sender.py'),
+                   init_globals={'heartbeat': heartbeat}, run_name='__main__')
+    log_writer.stop()
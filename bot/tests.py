@@ -1,3 +1,932 @@
-from django.test import TestCase
+import os
+import json
+import time
+import itertools
+import datetime
+import asyncio
+import threading
+import shutil
+import socket
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import tempfile
+from unittest import mock
+from contextlib import suppress
+from django.conf import settings
+from django.core.management import call_command, CommandError
+from django.test import TestCase, RequestFactory, override_settings
+from django.middleware.csrf import CsrfViewMiddleware
+from django.core.exceptions import ImproperlyConfigured
+from telebot import TeleBot
+from telebot.types import CallbackQuery, Message
 
-# Create your tests here.
+from bot import models, utils, cache, bans, dedup, ratelimit, state_storage, metrics, inline, misc, archive, texts, logwriter
+from bot.ingress import UpdateQueue, Consumer
+from bot.dispatcher import Dispatcher
+from bot.priority import Priority, Classifier
+from bot.updates import UpdateView, peek_user_id, dispatch
+from bot.prefs import preferences
+from bot.fsm import Step, Wizard, digits, active_users
+from bot.types import Log
+from bot.versions import VersionStamp
+from bot.transport import Transport
+from bot.polling import Poller
+
+# bot ships no migrations and its preferences models inherit from an app that has some:
+# the test database creates both straight from the models
+settings.MIGRATION_MODULES = {'preferences': None}
+
+runtime_dir = None
+runtime_settings = None
+
+
+def setUpModule():
+    """
+    Point the runtime SQLite file of the module level singletons at a temporary directory
+    """
+    global runtime_dir, runtime_settings
+    runtime_dir = tempfile.mkdtemp()
+    runtime_settings = override_settings(RUNTIME_DB_PATH=runtime_path(), LOG_BATCHED=False)
+    runtime_settings.enable()
+    # the constructors create the tables in the new file
+    preferences.stamp = VersionStamp('preferences', runtime_path())
+    bans.banlist.stamp = VersionStamp('bans', runtime_path())
+    cache.user_cache.__init__(path=runtime_path())
+    dedup._deduplicator = ratelimit._limiter = state_storage._storage = None
+
+
+def tearDownModule():
+    runtime_settings.disable()
+    shutil.rmtree(runtime_dir, ignore_errors=True)
+
+
+def runtime_path():
+    return f'{runtime_dir}/runtime.sqlite3'
+
+
+class TextsMixin:
+    TEXTS = {'btn_faq': 'FAQ', 'btn_back': 'Back', 'btn_support': 'Support', 'btn_add_order': 'Add order',
+             'btn_order_history': 'History'}
+
+    def setUp(self):
+        super().setUp()
+        texts = models.Texts.singleton.get()
+        for name, value in self.TEXTS.items():
+            setattr(texts, name, value)
+        texts.save()
+        # on_commit never fires inside a TestCase
+        preferences.invalidate()
+
+
+def press(markup, callback_data, user_id=1):
+    message = {'message_id': 1, 'date': 0, 'chat': {'id': user_id, 'type': 'private'}, 'text': 'x',
+               'reply_markup': json.loads(markup.to_json())}
+    return CallbackQuery.de_json({'id': '1', 'from': {'id': user_id, 'is_bot': False, 'first_name': 'A'},
+                                  'chat_instance': 'x', 'data': callback_data, 'message': message})
+
+
+class ButtonLabelTest(TextsMixin, TestCase):
+    def assertPressLogged(self, btn_set, other, callback_data, label):
+        markup = utils.ButtonSet(btn_set)
+        utils.ButtonSet(other)
+        callback = press(markup, callback_data)
+        self.assertEqual(utils.button_label(callback), label)
+
+        user = models.User.objects.create(user_id=1)
+        utils.logger_middleware(Log.INLINE_BUTTON, is_callback=True)(lambda *args: None)(callback.message, callback, user)
+        self.assertEqual(models.LogCounter.objects.get(type=Log.INLINE_BUTTON).content, label)
+
+    def test_faq_is_not_logged_as_back(self):
+        self.assertPressLogged(utils.ButtonSet.INL_HELP, utils.ButtonSet.INL_QUESTION,
+                               utils.set_callback(utils.CallbackFuncs.FAQ), 'FAQ')
+
+    def test_history_is_not_logged_as_back(self):
+        self.assertPressLogged(utils.ButtonSet.INL_ORDERS, utils.ButtonSet.INL_ORDER_HISTORY_ORDER,
+                               utils.set_callback(utils.CallbackFuncs.ORDER_HISTORY), 'History')
+
+
+class KeyboardParityTest(TextsMixin, TestCase):
+    def test_prepared_keyboards_match_the_built_ones(self):
+        items = [('Shop <1>', 1), ('Shop "2"', 2), ('Магазин', 3)]
+        cases = [(utils.ButtonSet.START, None), (utils.ButtonSet.INL_ORDERS, None), (utils.ButtonSet.INL_HELP, None),
+                 (utils.ButtonSet.INL_QUESTION, None), (utils.ButtonSet.INL_ORDER_HISTORY_ORDER, None),
+                 (utils.ButtonSet.INL_INVOICE, 'https://example.com/pay')]
+        cases += [(btn_set, items) for btn_set in utils.DYNAMIC_KEYBOARDS]
+        for btn_set, args in cases:
+            for row_width in (1, 2):
+                with self.subTest(btn_set=btn_set, row_width=row_width):
+                    self.assertEqual(json.loads(utils.ButtonSet(btn_set, args, row_width).to_json()),
+                                     json.loads(utils.ButtonSet.build(btn_set, args, row_width).to_json()))
+
+    def test_empty_keyboards_are_omitted(self):
+        self.assertFalse(utils.ButtonSet(utils.ButtonSet.INL_ORDER_SHOPS, []))
+        self.assertFalse(utils.ButtonSet.build(utils.ButtonSet.INL_ORDER_SHOPS, []))
+
+
+class UpdateQueueTest(TestCase):
+    def setUp(self):
+        self.queue = UpdateQueue(f'{runtime_dir}/queue-{self._testMethodName}.sqlite3')
+
+    def test_claim_leases_rows_until_ack(self):
+        self.queue.put(b'1', 1)
+        self.queue.put(b'2', 2)
+        rows = self.queue.claim(lease=60)
+        self.assertEqual([(body, attempts) for _, body, attempts in rows], [(b'1', 0), (b'2', 0)])
+        self.assertEqual(self.queue.claim(lease=60), [])
+        self.queue.ack(rows[0][0])
+        self.assertEqual(self.queue.depth(), 1)
+
+    def test_expired_lease_is_claimed_again(self):
+        self.queue.put(b'1', 1)
+        self.queue.claim(lease=-1)
+        self.assertEqual([(body, attempts) for _, body, attempts in self.queue.claim(lease=60)], [(b'1', 1)])
+
+    def test_extended_lease_is_not_claimed(self):
+        self.queue.put(b'1', 1)
+        rows = self.queue.claim(lease=-1)
+        self.queue.extend([rows[0][0]], lease=60)
+        self.assertEqual(self.queue.claim(lease=60), [])
+
+    def test_claim_by_shard(self):
+        for user_id in (1, 2, -3):
+            self.queue.put(str(user_id).encode(), user_id)
+        self.assertEqual([body for _, body, _ in self.queue.claim(shard=(1, 2))], [b'1', b'-3'])
+        self.assertEqual([body for _, body, _ in self.queue.claim(shard=(0, 2))], [b'2'])
+
+
+# unique per run: the dedup window persists in the runtime file shared by the tests
+update_ids = itertools.count(int(time.time() * 1000))
+
+
+class ConsumerDedupTest(TestCase):
+    def view(self, update_id):
+        return UpdateView.parse(json.dumps({'update_id': update_id, 'message': {
+            'message_id': 1, 'date': 0, 'chat': {'id': 1, 'type': 'private'}, 'from': {'id': 1, 'is_bot': False, 'first_name': 'A'}, 'text': 'x'}}))
+
+    @mock.patch('bot.ingress.process_update')
+    def test_redelivered_update_is_handled_once(self, process_update):
+        update_id = next(update_ids)
+        Consumer.handle((1, self.view(update_id), 0))
+        # the same update queued again, or the row claimed again after its lease ran out
+        Consumer.handle((2, self.view(update_id), 0))
+        Consumer.handle((1, self.view(update_id), 1))
+        self.assertEqual(process_update.call_count, 1)
+
+    @mock.patch('bot.ingress.process_update', side_effect=RuntimeError)
+    def test_failed_update_is_retried(self, process_update):
+        update_id = next(update_ids)
+        with self.assertRaises(RuntimeError):
+            Consumer.handle((1, self.view(update_id), 0))
+        process_update.side_effect = None
+        Consumer.handle((1, self.view(update_id), 1))
+        self.assertEqual(process_update.call_count, 2)
+
+
+class DispatcherTest(TestCase):
+    def test_stalled_while_an_item_is_handled_too_long(self):
+        release = threading.Event()
+        dispatcher = Dispatcher(lambda item: release.wait(5), workers=2, name='test-dispatcher').start()
+        self.assertFalse(dispatcher.is_stalled(0))
+        dispatcher.submit(1, 'item')
+        time.sleep(.05)
+        self.assertTrue(dispatcher.is_stalled(0))
+        self.assertFalse(dispatcher.is_stalled(60))
+        release.set()
+        dispatcher.join()
+        self.assertFalse(dispatcher.is_stalled(0))
+        dispatcher.stop()
+
+    def blocked(self, handled, **kwargs):
+        release = threading.Event()
+        dispatcher = Dispatcher(lambda item: release.wait(5) and handled.append(item), workers=1,
+                                name='test-dispatcher', **kwargs).start()
+        dispatcher.submit(1, 'first')
+        time.sleep(.05)
+        return dispatcher, release
+
+    def test_critical_users_go_first(self):
+        handled = []
+        dispatcher, release = self.blocked(handled)
+        for key, item, priority in ((2, 'normal', Priority.NORMAL), (3, 'low', Priority.LOW),
+                                    (4, 'critical', Priority.CRITICAL), (5, 'normal 2', Priority.NORMAL)):
+            dispatcher.submit(key, item, priority=priority)
+        release.set()
+        dispatcher.stop()
+        self.assertEqual(handled, ['first', 'critical', 'normal', 'normal 2', 'low'])
+
+    def test_one_user_stays_in_order(self):
+        handled = []
+        dispatcher, release = self.blocked(handled)
+        for key, item, priority in ((2, 'text', Priority.NORMAL), (3, 'other', Priority.NORMAL),
+                                    (2, 'add order', Priority.CRITICAL), (2, 'media', Priority.LOW)):
+            dispatcher.submit(key, item, priority=priority)
+        release.set()
+        dispatcher.stop()
+        # the critical item brings its user's earlier text ahead of user 3, never past it
+        self.assertEqual(handled, ['first', 'text', 'add order', 'other', 'media'])
+
+    @override_settings(SHED_DEPTH=1)
+    def test_shed_reply_is_sent_at_once(self):
+        handled, shed, done = [], threading.Event(), []
+        dispatcher, release = self.blocked(handled, on_shed=lambda item: shed.set())
+        dispatcher.submit(1, 'normal')
+        self.assertFalse(dispatcher.submit(1, 'low', done=done.append, priority=Priority.LOW))
+        self.assertTrue(shed.wait(1))
+        release.set()
+        dispatcher.stop()
+        self.assertEqual((handled, done), (['first', 'normal'], ['low']))
+
+
+class MetricsPublisherTest(TestCase):
+    def test_publisher_thread_publishes_once_per_process(self):
+        self.addCleanup(setattr, metrics, '_publisher', metrics._publisher)
+        metrics._publisher = None
+        metrics.start_publisher('test-web')
+        thread = metrics._publisher
+        metrics.start_publisher('test-web')
+        self.assertIs(metrics._publisher, thread)
+        deadline = time.time() + 5
+        while 'test-web' not in metrics.collect() and time.time() < deadline:
+            time.sleep(.01)
+        self.assertIn('test-web', metrics.collect())
+
+
+class RecordingWriter(logwriter.LogWriter):
+    """
+    LogWriter keeping its batches instead of writing them
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.batches = []
+        self.saved = threading.Event()
+
+    def save(self, rows, counts):
+        if rows or counts:
+            self.batches.append((rows, dict(counts)))
+            self.saved.set()
+
+
+class LogWriterTest(TestCase):
+    def setUp(self):
+        self.addCleanup(metrics.register, 'logs', logwriter.log_writer.stats)
+
+    def writer(self, started=True, **kwargs):
+        writer = RecordingWriter(**kwargs)
+        if not started:
+            # no flusher thread: rows stay buffered
+            writer.thread = threading.current_thread()
+        self.addCleanup(writer.stop)
+        return writer
+
+    def test_batch_by_size(self):
+        writer = self.writer(batch_size=2, interval=60)
+        writer.count(('day', Log.TEXT, ''))
+        writer.write('a')
+        writer.write('b')
+        self.assertTrue(writer.saved.wait(5))
+        self.assertEqual(writer.batches, [(['a', 'b'], {('day', Log.TEXT, ''): 1})])
+
+    def test_batch_by_interval(self):
+        writer = self.writer(batch_size=100, interval=.05)
+        writer.write('a')
+        self.assertTrue(writer.saved.wait(5))
+        self.assertEqual(writer.batches, [(['a'], {})])
+
+    def test_overflow_drop(self):
+        writer = self.writer(started=False, capacity=2, overflow='drop')
+        self.assertEqual([writer.write(x) for x in 'abc'], [True, True, False])
+        self.assertEqual((writer.rows, writer.dropped), (['a', 'b'], 1))
+
+    def test_overflow_block(self):
+        writer = self.writer(started=False, capacity=1, overflow='block')
+        writer.write('a')
+        thread = threading.Thread(target=writer.write, args=('b',))
+        thread.start()
+        thread.join(.1)
+        self.assertTrue(thread.is_alive())
+        writer.flush()
+        thread.join(5)
+        self.assertEqual((writer.batches, writer.rows, writer.dropped), ([(['a'], {})], ['b'], 0))
+
+    def test_stop_flushes_the_buffer(self):
+        writer = self.writer(batch_size=100, interval=60)
+        writer.write('a')
+        writer.stop()
+        self.assertEqual([rows for rows, _ in writer.batches], [['a']])
+        self.assertFalse(writer.thread.is_alive())
+
+    def test_forked_child_forgets_the_buffer(self):
+        writer = logwriter.log_writer
+        with writer.condition:
+            writer.rows.append('parent')
+        self.addCleanup(writer.rows.remove, 'parent')
+        read, write = os.pipe()
+        pid = os.fork()
+        if not pid:
+            os.write(write, json.dumps([len(writer.rows), writer.thread is None]).encode())
+            os._exit(0)
+        os.waitpid(pid, 0)
+        os.close(write)
+        self.assertEqual(json.loads(os.read(read, 100)), [0, True])
+        os.close(read)
+        self.assertEqual(writer.rows, ['parent'])
+
+
+class LogPolicyTest(TestCase):
+    def test_parse_policy(self):
+        self.assertEqual(logwriter.parse_policy('TEXT', 'full'), ('full', 100.))
+        self.assertEqual(logwriter.parse_policy('TEXT', 'sample:12.5'), ('sample', 12.5))
+        self.assertEqual(logwriter.parse_policy('TEXT', 'counter'), ('counter', 0.))
+        self.assertEqual(logwriter.parse_policy('TEXT', 'off'), ('off', 0.))
+        for policy in ('sample', 'sample:101', 'sample:-1', 'sample:x', 'full:50', 'all'):
+            with self.assertRaises(ImproperlyConfigured, msg=policy):
+                logwriter.parse_policy('TEXT', policy)
+
+    def write(self, type_, policy, random=0.):
+        user = models.User.objects.get_or_create(user_id=1)[0]
+        with mock.patch.dict(logwriter.policies, {type_: logwriter.parse_policy(type_, policy)}), \
+                mock.patch.object(logwriter.random, 'random', return_value=random):
+            logwriter.write(models.Log(user=user, type=type_, content='/start'))
+
+    def stored(self, type_):
+        counted = models.LogCounter.objects.filter(type=type_).values_list('count', flat=True).first() or 0
+        return counted, models.Log.objects.filter(type=type_).count()
+
+    def test_sampled_rows_are_all_counted(self):
+        self.write(Log.COMMAND, 'sample:10', random=.05)
+        self.write(Log.COMMAND, 'sample:10', random=.5)
+        self.assertEqual(self.stored(Log.COMMAND), (2, 1))
+
+    def test_counter_only(self):
+        self.write(Log.INLINE_BUTTON, 'counter')
+        self.assertEqual(self.stored(Log.INLINE_BUTTON), (1, 0))
+
+    def test_off(self):
+        self.write(Log.TEXT, 'off')
+        self.assertEqual(self.stored(Log.TEXT), (0, 0))
+
+
+class AsyncWebhookTest(TestCase):
+    def test_async_view_is_a_csrf_exempt_coroutine(self):
+        from bot.views import update_async
+        self.assertTrue(asyncio.iscoroutinefunction(update_async))
+        request = RequestFactory().post('/webhook', b'{}', content_type='application/json')
+        self.assertIsNone(CsrfViewMiddleware(lambda r: None).process_view(request, update_async, (), {}))
+
+    def test_async_view_requires_the_queue(self):
+        from bot.views import check_settings
+        with override_settings(WEBHOOK_ASYNC=True, WEBHOOK_QUEUE=False), self.assertRaises(ImproperlyConfigured):
+            check_settings()
+        with override_settings(WEBHOOK_ASYNC=True, WEBHOOK_QUEUE=True):
+            check_settings()
+
+
+class InlineReplyTest(TestCase):
+    def message(self):
+        return Message.de_json({'message_id': 1, 'date': 0, 'chat': {'id': 1, 'type': 'private'},
+                                'from': {'id': 1, 'is_bot': False, 'first_name': 'A'}, 'text': 'x'})
+
+    def test_html_validation(self):
+        for text in ('plain', '<b>bold</b> &amp; <a href="https://t.me">link</a>', '&#128512; &lt;3', '<code>x</code>\n'):
+            self.assertTrue(inline.is_valid_html(text), text)
+        for text in ('a < b', 'a & b', '<b>open', '<b><i>x</b></i>', '<div>x</div>', 'x</b>'):
+            self.assertFalse(inline.is_valid_html(text), text)
+
+    @mock.patch.object(misc.bot, 'send_message')
+    def test_valid_html_is_returned_inline(self, send_message):
+        with inline.capture() as slot:
+            utils.answer(self.message(), '<b>hi</b>')
+        self.assertEqual(slot.reply['text'], '<b>hi</b>')
+        send_message.assert_not_called()
+
+    @mock.patch.object(misc.bot, 'send_message')
+    def test_invalid_html_is_sent_directly(self, send_message):
+        with inline.capture() as slot:
+            utils.answer(self.message(), 'a < b')
+        self.assertIsNone(slot.reply)
+        send_message.assert_called_once()
+
+
+class UserCacheTest(TestCase):
+    def setUp(self):
+        self.user = models.User.objects.create(user_id=42)
+        self.cache = cache.UserCache(size=10, ttl=60, path=runtime_path())
+
+    def test_hit_until_another_process_saves_the_user(self):
+        user, version = self.cache.get(42)
+        self.assertIsNone(user)
+        self.cache.put(self.user, version)
+        self.assertIs(self.cache.get(42)[0], self.user)
+        # a save in another process only shows up as a new version of the user
+        cache.UserCache(path=runtime_path()).changed(42)
+        self.assertIsNone(self.cache.get(42)[0])
+
+    def test_own_save_keeps_the_entry(self):
+        self.cache.put(self.user, self.cache.get(42)[1])
+        self.cache.changed(42, self.user)
+        self.assertIs(self.cache.get(42)[0], self.user)
+        self.cache.changed(42, models.User(user_id=42))
+        self.assertIsNone(self.cache.get(42)[0])
+
+    def test_save_bumps_the_version_on_commit(self):
+        version = cache.user_cache.version(42)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.is_banned = True
+            self.user.save()
+        self.assertEqual(cache.user_cache.version(42), version + 1)
+
+    def test_fields_left_out_of_a_save_stay_dirty(self):
+        user = models.User.objects.get(user_id=42)
+        user.username, user.first_name = 'name', 'First'
+        user.save(update_fields=['username'])
+        self.assertEqual(user.get_dirty_fields(), ['first_name'])
+        self.assertTrue(user.save_dirty())
+        self.assertFalse(user.save_dirty())
+        self.assertEqual(models.User.objects.values_list('username', 'first_name').get(user_id=42), ('name', 'First'))
+
+    def test_ban_is_applied_on_commit(self):
+        version = bans.banlist.stamp.get()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.is_banned = True
+            self.user.save()
+            # other processes would reload the banlist before the row is visible to them
+            self.assertEqual(bans.banlist.stamp.get(), version)
+        self.assertNotEqual(bans.banlist.stamp.get(), version)
+        self.assertTrue(bans.banlist.is_banned(42))
+
+
+class RollupTest(TestCase):
+    def setUp(self):
+        self.user = models.User.objects.create(user_id=1)
+        self.today = datetime.date.today()
+        # the log writer counts from today on
+        models.LogCounter.objects.create(day=self.today, type=Log.COMMAND, content='/start', count=1)
+        self.old = datetime.datetime.combine(self.today - datetime.timedelta(days=40), datetime.time(12),
+                                             tzinfo=datetime.timezone.utc)
+        for content in ('/start', '/start', '/help'):
+            log = models.Log.objects.create(user=self.user, type=Log.COMMAND, content=content)
+            models.Log.objects.filter(id=log.id).update(created=self.old)
+        # logged on the deploy day before the writer started counting
+        models.Log.objects.create(user=self.user, type=Log.COMMAND, content='/help')
+        archive.rollup_mark()
+        models.Log.objects.create(user=self.user, type=Log.COMMAND, content='/start')
+
+    def totals(self):
+        return dict(models.LogCounter.objects.filter(day=self.old.date()).values_list('content', 'count'))
+
+    def test_archived_logs_are_rolled_up_first(self):
+        root = tempfile.mkdtemp(dir=runtime_dir)
+        self.assertEqual(archive.archive_logs(self.old + datetime.timedelta(days=1), root=root), 3)
+        self.assertEqual(self.totals(), {'/start': 2, '/help': 1})
+        self.assertEqual(models.LogCounter.objects.get(day=self.today, content='/start').count, 1)
+
+    def test_rollup_is_resumable(self):
+        self.assertEqual(archive.rollup_logs(chunk=2), 4)
+        self.assertEqual(archive.rollup_logs(), 0)
+        self.assertEqual(self.totals(), {'/start': 2, '/help': 1})
+
+    def test_first_day_is_counted_up_to_the_mark(self):
+        archive.rollup_logs()
+        self.assertEqual(dict(models.LogCounter.objects.filter(day=self.today).values_list('content', 'count')),
+                         {'/start': 1, '/help': 1})
+
+
+class ArchiveReadTest(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(dir=runtime_dir)
+        self.today = datetime.date.today()
+        for user_id, days, content in ((1, 10, 'old'), (12, 2, '"user_id": 1,'), (1, 2, 'first'), (1, 1, 'second')):
+            user = models.User.objects.get_or_create(user_id=user_id)[0]
+            log = models.Log.objects.create(user=user, type=Log.TEXT, content=content)
+            models.Log.objects.filter(id=log.id).update(created=datetime.datetime.combine(
+                self.today - datetime.timedelta(days=days), datetime.time(12), tzinfo=datetime.timezone.utc))
+        archive.archive_logs(datetime.datetime.now(datetime.timezone.utc), root=self.root)
+
+    def read(self, user_id, since=None):
+        return [row['content'] for row in archive.read_user_logs(user_id, since, root=self.root)]
+
+    def test_rows_of_the_user_newest_first(self):
+        self.assertEqual(self.read(1), ['second', 'first', 'old'])
+        self.assertEqual(self.read(12), ['"user_id": 1,'])
+
+    def test_older_segments_are_skipped(self):
+        self.assertEqual(self.read(1, self.today - datetime.timedelta(days=5)), ['second', 'first'])
+
+
+class DatabaseStorageTest(TestCase):
+    def test_expire_drops_only_stale_states(self):
+        storage = state_storage.DatabaseStorage()
+        now = time.time()
+        states = {1: ('old', {state_storage.TIMESTAMP: now - 100}), 2: ('new', {state_storage.TIMESTAMP: now}),
+                  3: ('untimed', {'field': 1}), 4: ('empty', {}), 5: (None, {})}
+        users = {}
+        for user_id, (state, data) in states.items():
+            users[user_id] = models.User.objects.create(user_id=user_id)
+            storage.set(users[user_id], state, data)
+        self.assertEqual(storage.expire(now - 10), 3)
+        self.assertEqual(dict(models.User.objects.exclude(state=None).values_list('user_id', 'state')), {2: 'new'})
+
+
+class FakeRedisHandler(socketserver.StreamRequestHandler):
+    """
+    Just enough RESP for RedisStorage: AUTH, SELECT, GET, SET and DEL
+    """
+
+    def handle(self):
+        self.server.clients.append(self.request)
+        authenticated = False
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            args = []
+            for _ in range(int(line[1:])):
+                length = int(self.rfile.readline()[1:])
+                args.append(self.rfile.read(length + 2)[:-2].decode())
+            name = args[0].upper()
+            self.server.commands.append(name)
+            if name == 'AUTH' and self.server.drop_auth:
+                self.server.drop_auth -= 1
+                return
+            if name == 'AUTH':
+                authenticated = args[-1] == self.server.password
+                reply = b'+OK\r\n' if authenticated else b'-WRONGPASS invalid password\r\n'
+            elif not authenticated:
+                reply = b'-NOAUTH Authentication required.\r\n'
+            elif name == 'SELECT':
+                reply = b'+OK\r\n'
+            elif name == 'GET':
+                value = self.server.data.get(args[1])
+                reply = b'$-1\r\n' if value is None else b'$%d\r\n%s\r\n' % (len(value.encode()), value.encode())
+            elif name == 'SET':
+                self.server.data[args[1]] = args[2]
+                reply = b'+OK\r\n'
+            else:
+                reply = b':%d\r\n' % (self.server.data.pop(args[1], None) is not None)
+            self.wfile.write(reply)
+
+    def finish(self):
+        with suppress(OSError):
+            super().finish()
+
+
+class RedisStorageTest(TestCase):
+    def setUp(self):
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), FakeRedisHandler)
+        self.server.daemon_threads = True
+        self.server.password, self.server.data, self.server.commands, self.server.clients = 'secret', {}, [], []
+        self.server.drop_auth = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.storage = state_storage.RedisStorage(f'redis://:secret@127.0.0.1:{self.server.server_address[1]}/2')
+        self.user = models.User(user_id=7)
+
+    def test_set_get_reset(self):
+        self.storage.set(self.user, 'amount', {'shop': 1})
+        self.assertEqual(self.storage.get(self.user), ('amount', {'shop': 1}))
+        self.storage.reset(self.user)
+        self.assertEqual(self.storage.get(self.user), (None, {}))
+        self.assertEqual(self.server.commands[:2], ['AUTH', 'SELECT'])
+
+    def test_reconnect_authenticates_again(self):
+        self.storage.set(self.user, 'amount', {})
+        for client in self.server.clients:
+            client.shutdown(socket.SHUT_RDWR)
+        self.assertEqual(self.storage.get(self.user), ('amount', {}))
+        self.assertEqual(self.server.commands.count('AUTH'), 2)
+
+    def test_connection_dropped_during_auth(self):
+        self.server.drop_auth = 1
+        with self.assertRaises(ConnectionError):
+            self.storage.get(self.user)
+        self.assertIsNone(self.storage.local.sock)
+        self.assertEqual(self.storage.get(self.user), (None, {}))
+
+    def test_failed_auth_leaves_no_connection(self):
+        self.storage.password = 'wrong'
+        with self.assertRaises(state_storage.RedisError):
+            self.storage.get(self.user)
+        self.storage.password = 'secret'
+        self.assertEqual(self.storage.get(self.user), (None, {}))
+
+
+class FakeApiHandler(BaseHTTPRequestHandler):
+    """
+    Answers the Bot API calls with the queued retry_after values (429) until they run out, then with ok
+    """
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self.server.calls.append(self.path.split('?')[0].rsplit('/', 1)[-1])
+        if self.server.retry_after:
+            status, body = 429, {'ok': False, 'error_code': 429,
+                                 'parameters': {'retry_after': self.server.retry_after.pop(0)}}
+        else:
+            status, body = 200, {'ok': True, 'result': True}
+        body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TransportTest(TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeApiHandler)
+        self.server.daemon_threads = True
+        self.server.calls, self.server.retry_after = [], []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.transport = Transport(retries=0, rate_limited=False)
+        # handles 429s without replacing the telebot sender of the process
+        self.transport.installed = True
+        self.limiter = mock.Mock()
+        for patcher in (mock.patch.object(ratelimit, 'get_limiter', return_value=self.limiter),
+                        mock.patch('bot.transport.time.sleep')):
+            self.sleep = patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def send(self, *retry_after, method='sendMessage', **kwargs):
+        self.server.retry_after.extend(retry_after)
+        return self.transport.request('post', f'http://127.0.0.1:{self.server.server_address[1]}/bot0:test/{method}',
+                                      params={'chat_id': 5}, **kwargs).status_code
+
+    def test_429_is_retried_after_the_pause(self):
+        self.assertEqual(self.send(3), 200)
+        self.assertEqual(self.server.calls, ['sendMessage', 'sendMessage'])
+        self.limiter.pause.assert_called_once_with(5, 3.)
+        self.sleep.assert_called_once_with(3.)
+
+    def test_broadcast_pauses_the_global_lane(self):
+        with ratelimit.lane(ratelimit.Lane.BROADCAST):
+            self.assertEqual(self.send(20), 200)
+        # a broadcast may wait longer than RETRY_429_MAX_WAIT
+        self.limiter.pause.assert_called_once_with(None, 20.)
+
+    def test_interactive_call_gives_up_past_max_wait(self):
+        self.assertEqual(self.send(20), 429)
+        self.assertEqual(len(self.server.calls), 1)
+        self.limiter.pause.assert_called_once_with(5, 20.)
+        self.sleep.assert_not_called()
+
+    @override_settings(RETRY_429_ATTEMPTS=2)
+    def test_attempts_are_limited(self):
+        self.assertEqual(self.send(1, 1, 1), 429)
+        self.assertEqual(len(self.server.calls), 3)
+
+    def test_uploads_are_not_retried(self):
+        self.assertEqual(self.send(1, method='sendPhoto', files={'photo': ('photo.jpg', b'jpeg')}), 429)
+        self.assertEqual(self.server.calls, ['sendPhoto'])
+        # the lane is still paused for the calls that follow
+        self.limiter.pause.assert_called_once_with(5, 1.)
+
+
+class PollerTest(TestCase):
+    @staticmethod
+    def update(update_id, user_id):
+        return {'update_id': update_id, 'message': {'message_id': 1, 'date': 0, 'text': 'x', 'from': {'id': user_id},
+                                                    'chat': {'id': user_id, 'type': 'private'}}}
+
+    def test_offset_is_saved_once_the_batch_is_handled(self):
+        path = f'{runtime_dir}/offset-{self._testMethodName}'
+        first, second = next(update_ids), next(update_ids)
+        batches, fetched, handled, stop = [[self.update(first, 1), self.update(second, 2)]], [], [], threading.Event()
+
+        def handle(view):
+            time.sleep(.05)
+            handled.append((view.update_id, poller.load_offset()))
+
+        def fetch():
+            fetched.append(poller.offset)
+            if batches:
+                return batches.pop(0)
+            stop.set()
+            return []
+        with mock.patch('bot.polling.process_update', handle):
+            poller = Poller(path=path, workers=2)
+        poller.fetch = fetch
+        poller.run(stop)
+        # nothing was checkpointed while the batch was handled
+        self.assertEqual(sorted(handled), [(first, None), (second, None)])
+        self.assertEqual(fetched, [None, second + 1])
+        # a restart resumes after the batch
+        self.assertEqual(Poller(path=path).offset, second + 1)
+
+
+class PeekUserIdTest(TestCase):
+    def assertPeeked(self, update, user_id):
+        for separators in ((',', ':'), (', ', ': ')):
+            body = json.dumps({'update_id': 1, **update}, separators=separators).encode()
+            self.assertEqual(peek_user_id(body), user_id)
+            self.assertEqual(peek_user_id(body), UpdateView.parse(body).user_id)
+
+    def test_sender_of_the_update(self):
+        self.assertPeeked({'message': {'message_id': 1, 'from': {'id': 5}, 'text': 'say "hi"',
+                                       'reply_to_message': {'from': {'id': 9}}}}, 5)
+        self.assertPeeked({'callback_query': {'id': '1', 'from': {'id': -6}, 'message': {'from': {'id': 9}}}}, -6)
+
+    def test_nested_from_is_not_the_sender(self):
+        self.assertPeeked({'message': {'message_id': 1, 'reply_to_message': {'from': {'id': 9}}, 'from': {'id': 5}}}, 5)
+        self.assertPeeked({'channel_post': {'message_id': 1, 'chat': {'id': -100},
+                                            'reply_to_message': {'from': {'id': 9}}}}, -100)
+        self.assertPeeked({'poll_answer': {'poll_id': '1', 'user': {'id': 8}}}, 8)
+
+    def test_invalid_body(self):
+        self.assertIsNone(peek_user_id(b'not json'))
+
+
+class DispatchTest(TestCase):
+    def test_only_the_handlers_of_the_update_type_run(self):
+        bot, handled = TeleBot('0:test', threaded=False), []
+        bot.message_handler(func=lambda message: True)(lambda message: handled.append(('message', message.text)))
+        bot.callback_query_handler(func=lambda call: True)(lambda call: handled.append(('callback', call.data)))
+        sender = {'id': 1, 'is_bot': False, 'first_name': 'A'}
+        dispatch(bot, UpdateView.parse(json.dumps({'update_id': 5, 'message': {
+            'message_id': 1, 'date': 0, 'chat': {'id': 1, 'type': 'private'}, 'from': sender, 'text': 'x'}})))
+        dispatch(bot, UpdateView.parse(json.dumps({'update_id': 6, 'callback_query': {
+            'id': '1', 'from': sender, 'chat_instance': 'x', 'data': 'data'}})))
+        self.assertEqual(handled, [('message', 'x'), ('callback', 'data')])
+        self.assertEqual(bot.last_update_id, 6)
+
+
+class TemplateTest(TestCase):
+    def test_render(self):
+        template = texts.compile_text('profile', 'Since {first_launch}: {orders_qty} orders, {total:.2f} {fee!r}')
+        self.assertEqual(template.render(first_launch='today', orders_qty=2, total=3, fee='1%'),
+                         "Since today: 2 orders, 3.00 '1%'")
+
+    def test_invalid_placeholders(self):
+        for text in ('{name}', '{total:{fee}}', '{total!x}', '{total'):
+            with self.assertRaises(ValueError, msg=text):
+                texts.compile_text('profile', text)
+
+    def test_texts_saved_before_validation_are_sent_as_is(self):
+        self.assertEqual(texts.Templates.load('profile', 'Hi {name}').render(total=1), 'Hi {name}')
+
+    def test_recompiled_when_preferences_change(self):
+        templates = texts.Templates()
+        profile = models.Texts.singleton.get()
+        for value in ('{total}', 'Total: {total}'):
+            profile.profile = value
+            profile.save()
+            preferences.invalidate()
+            self.assertEqual(templates.render('profile', total=1), value.replace('{total}', '1'))
+
+
+@override_settings(RATE_LIMIT_GLOBAL=10, RATE_LIMIT_BROADCAST_RESERVE=4, RATE_LIMIT_CHAT=1, RATE_LIMIT_CHAT_BURST=3)
+class RateLimiterTest(TestCase):
+    def setUp(self):
+        self.limiter = ratelimit.RateLimiter(f'{runtime_dir}/limits-{self._testMethodName}.sqlite3')
+        patcher = mock.patch.object(ratelimit.time, 'time', return_value=1000.)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def granted(self, chat_id, lane, attempts=20):
+        return sum(not self.limiter.try_acquire(chat_id, lane) for _ in range(attempts))
+
+    def test_broadcast_leaves_the_reserve_to_interactive_calls(self):
+        self.assertEqual(self.granted(None, ratelimit.Lane.BROADCAST), 6)
+        self.assertEqual(self.granted(None, ratelimit.Lane.INTERACTIVE), 4)
+        self.assertAlmostEqual(self.limiter.try_acquire(None, ratelimit.Lane.BROADCAST), .5)
+
+    def test_chat_burst(self):
+        self.assertEqual(self.granted(1, ratelimit.Lane.INTERACTIVE), 3)
+        self.assertAlmostEqual(self.limiter.try_acquire(1), 1.)
+        self.assertEqual(self.granted(2, ratelimit.Lane.INTERACTIVE), 3)
+
+    def test_pause(self):
+        self.limiter.pause(1, 5)
+        self.assertAlmostEqual(self.limiter.try_acquire(1), 5.)
+        self.assertEqual(self.limiter.try_acquire(2), 0.)
+
+
+class DeduplicatorTest(TestCase):
+    def setUp(self):
+        self.path = f'{runtime_dir}/dedup-{self._testMethodName}.sqlite3'
+
+    def test_seen_across_processes(self):
+        first, other = dedup.Deduplicator(path=self.path), dedup.Deduplicator(path=self.path)
+        self.assertFalse(first.seen(1))
+        self.assertTrue(first.seen(1))
+        # another process (or a restart) only shares the persisted window
+        self.assertTrue(other.is_duplicate(1))
+        self.assertFalse(other.is_duplicate(2))
+        self.assertFalse(first.seen(None))
+
+    def test_window_is_pruned(self):
+        deduplicator = dedup.Deduplicator(size=1, window=10, path=self.path)
+        for update_id in range(1, 31):
+            deduplicator.mark(update_id)
+        self.assertFalse(deduplicator.is_duplicate(5))
+        self.assertTrue(deduplicator.is_duplicate(25))
+
+
+class WizardTest(TestCase):
+    def setUp(self):
+        self.addCleanup(setattr, state_storage, '_storage', state_storage._storage)
+        state_storage._storage = state_storage.MemoryStorage()
+        self.prompted, self.finished = [], []
+        self.wizard = Wizard('test_wizard', steps={
+            'kind': Step('kind', lambda data: 'amount' if data['kind'] == 'paid' else 'comment', button=True),
+            'amount': Step('amount', 'comment', clean=digits),
+            'comment': Step('comment', None),
+        }, prompts=dict.fromkeys(('kind', 'amount', 'comment'), lambda message, user, data: self.prompted.append(data)),
+            finish=lambda message, user, data: self.finished.append(data), ttl=60)
+        self.user = models.User(user_id=1)
+        self.addCleanup(active_users.discard, 1)
+        patcher = mock.patch('bot.fsm.answer')
+        self.answer = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def feed(self, value, button=False):
+        state, data = self.wizard.current(self.user)
+        return self.wizard.feed(None, self.user, state, data, value, button=button)
+
+    def test_steps_until_finish(self):
+        self.wizard.start(None, self.user)
+        self.assertEqual(self.wizard.current(self.user)[0], 'kind')
+        self.assertTrue(self.feed('paid', button=True))
+        self.assertFalse(self.feed('ten'))
+        self.answer.assert_called_once()
+        self.assertEqual(self.wizard.current(self.user)[0], 'amount')
+        self.assertTrue(self.feed('10'))
+        self.assertTrue(self.feed('thanks'))
+        self.assertEqual(self.finished, [{'kind': 'paid', 'amount': 10, 'comment': 'thanks'}])
+        self.assertEqual(self.wizard.current(self.user), (None, {}))
+
+    def test_button_step_rejects_text(self):
+        self.wizard.start(None, self.user)
+        self.assertFalse(self.feed('paid'))
+        self.assertEqual(len(self.prompted), 2)
+        self.assertTrue(self.feed('free', button=True))
+        self.assertEqual(self.wizard.current(self.user)[0], 'comment')
+
+    def test_expired_state_is_dropped(self):
+        self.wizard.start(None, self.user)
+        with mock.patch('bot.fsm.time.time', return_value=time.time() + 61):
+            self.assertEqual(self.wizard.current(self.user), (None, {}))
+        self.assertEqual(state_storage.get_storage().get(self.user), (None, {}))
+
+    def test_input_of_users_in_the_wizard_is_critical(self):
+        classify, update_ids = Classifier(), itertools.count(1)
+
+        def priority(text):
+            return classify(UpdateView.parse(json.dumps({'update_id': next(update_ids), 'message': {
+                'message_id': 1, 'date': 0, 'chat': {'id': 1, 'type': 'private'}, 'from': {'id': 1}, 'text': text}})))
+        self.assertEqual(priority('hi'), Priority.NORMAL)
+        self.wizard.start(None, self.user)
+        self.feed('paid', button=True)
+        self.assertEqual(priority('10'), Priority.CRITICAL)
+        self.feed('10')
+        # the same text again is input of the next step, not a repeat
+        self.assertEqual(priority('10'), Priority.CRITICAL)
+        self.feed('10')
+        self.assertEqual(priority('thanks'), Priority.NORMAL)
+
+    def test_unknown_transition(self):
+        with self.assertRaises(ValueError):
+            Wizard('broken', steps={'a': Step('a', 'b')}, prompts={'a': 'order_log'}, finish=None)
+
+
+class StateStorageTest(TestCase):
+    def backends(self):
+        models.User.objects.create(user_id=7)
+        return (state_storage.DatabaseStorage(), state_storage.MemoryStorage(),
+                state_storage.SQLiteStorage(f'{runtime_dir}/states-{self._testMethodName}.sqlite3'))
+
+    def test_set_get_reset(self):
+        for storage in self.backends():
+            user = models.User.objects.get(user_id=7)
+            self.assertEqual(storage.get(user), (None, {}), storage)
+            storage.set(user, 'amount', {'shop': 1})
+            # read back through a fresh instance, as the next update would
+            self.assertEqual(storage.get(models.User.objects.get(user_id=7)), ('amount', {'shop': 1}), storage)
+            storage.reset(user)
+            self.assertEqual(storage.get(models.User.objects.get(user_id=7)), (None, {}), storage)
+
+    def test_expire(self):
+        for storage in self.backends()[1:]:
+            user = models.User(user_id=7)
+            storage.set(user, 'amount', {state_storage.TIMESTAMP: time.time()})
+            self.assertEqual(storage.expire(time.time() - 60), 0, storage)
+            self.assertEqual(storage.expire(time.time() + 60), 1, storage)
+            self.assertEqual(storage.get(user), (None, {}), storage)
+
+    def test_base_storage_is_abstract(self):
+        with self.assertRaises(TypeError):
+            state_storage.BaseStorage()
+
+
+class StartBotTest(TestCase):
+    @override_settings(WEBHOOK_QUEUE=False)
+    def test_supervise_requires_the_queue(self):
+        with mock.patch('bot.management.commands.startbot.bot') as bot, self.assertRaises(CommandError):
+            call_command('startbot', supervise=True)
+        bot.set_webhook.assert_not_called()
@@ -0,0 +1,97 @@
+import threading
+from string import Formatter
+from bot import metrics
+from bot.prefs import preferences
+
+try:
+    from bot.utils_lib.emoji import emojize
+except ImportError:
+    emojize = None
+
+# placeholders each handler supplies to a formatted text
+CONTEXTS = {
+    'profile': ('first_launch', 'orders_qty', 'total', 'fee'),
+    'order_full_info': ('date', 'log', 'shop', 'amount', 'status', 'pass1', 'pass2', 'comment'),
+    'shop_full_info': ('store', 'country', 'limit', 'qty', 'timeframe', 'comment'),
+    'btn_history_line': ('date', 'log', 'shop', 'amount', 'status'),
+}
+CONVERSIONS = {None: None, 's': str, 'r': repr, 'a': ascii}
+
+
+class Template:
+    """
+    Text split once into literal parts and (name, conversion, format_spec) fields, rendered with a join
+    """
+    __slots__ = ('parts',)
+
+    def __init__(self, text, context):
+        parts = []
+        for literal, name, spec, conversion in Formatter().parse(emojize(text) if emojize else text):
+            if literal and parts and parts[-1].__class__ is str:
+                parts[-1] += literal
+            elif literal:
+                parts.append(literal)
+            if name is None:
+                continue
+            if name not in context:
+                raise ValueError(f'Unknown placeholder {{{name}}}, available: ' + ', '.join(f'{{{x}}}' for x in context))
+            if '{' in spec:
+                raise ValueError(f'Nested placeholder in the format of {{{name}}}')
+            if conversion not in CONVERSIONS:
+                raise ValueError(f'Unknown conversion !{conversion} of {{{name}}}')
+            parts.append((name, CONVERSIONS[conversion], spec))
+        self.parts = tuple(parts)
+
+    def render(self, **context) -> str:
+        return ''.join([part if part.__class__ is str else
+                        format(part[1](context[part[0]]) if part[1] else context[part[0]], part[2])
+                        for part in self.parts])
+
+
+def compile_text(name, text) -> Template:
+    """
+    Raise ValueError if `text` does not fit the placeholders of `name`
+    """
+    return Template(text, CONTEXTS[name])
+
+
+class Templates:
+    """
+    Texts from CONTEXTS compiled once per preferences version
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        self.compiled = {}
+        metrics.register('texts', lambda: {'compiled': len(self.compiled)})
+
+    def get(self, name) -> Template:
+        texts = preferences.Texts
+        compiled = self.compiled
+        if texts.version != self.version or name not in compiled:
+            with self.lock:
+                if texts.version != self.version:
+                    self.compiled, self.version = {}, texts.version
+                if name not in self.compiled:
+                    self.compiled = {**self.compiled, name: self.load(name, getattr(texts, name))}
+                compiled = self.compiled
+        return compiled[name]
+
+    @staticmethod
+    def load(name, text) -> Template:
+        try:
+            return compile_text(name, text)
+        except ValueError:
+            # saved before validation existed: send it as is rather than fail the handler
+            metrics.incr('texts.invalid')
+            template = Template('', ())
+            template.parts = (text,)
+            return template
+
+    def render(self, name, **context) -> str:
+        return self.get(name).render(**context)
+
+
+templates = Templates()
+render = templates.render
@@ -0,0 +1,99 @@
+import os
+import time
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from telebot import apihelper
+from bot import ratelimit, metrics, inline
+
+
+class Transport:
+    """
+    Process-wide keep-alive connection pool for outbound HTTP calls.
+    Only connection errors are retried, a request that reached the server is never resent.
+    Message sending calls go through the rate limiter unless `rate_limited` is False.
+    """
+
+    def __init__(self, pool_size=None, connect_timeout=None, read_timeout=None, retries=None, rate_limited=None):
+        self.pool_size = pool_size or settings.TELEGRAM_POOL_SIZE
+        self.connect_timeout = connect_timeout or settings.TELEGRAM_CONNECT_TIMEOUT
+        self.read_timeout = read_timeout or settings.TELEGRAM_READ_TIMEOUT
+        self.retries = settings.TELEGRAM_CONNECT_RETRIES if retries is None else retries
+        self.rate_limited = settings.RATE_LIMIT_ENABLED if rate_limited is None else rate_limited
+        self.installed = False
+        self.session = self.create_session()
+
+    def create_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size,
+                              max_retries=Retry(total=None, connect=self.retries, read=0, status=0, other=0, backoff_factor=.1))
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def reset(self):
+        """
+        Drop the pooled connections, a forked child must not share the parent's sockets
+        """
+        self.session = self.create_session()
+        if self.installed:
+            self.install()
+
+    def request(self, method, url, params=None, files=None, timeout=None, proxies=None, **kwargs):
+        sends_message = url.rsplit('/', 1)[-1] in ratelimit.LIMITED_METHODS
+        limited = self.installed and self.rate_limited and sends_message
+        chat_id = (params or {}).get('chat_id')
+        if sends_message:
+            inline.flush(chat_id)
+        attempt = 0
+        while True:
+            if limited:
+                ratelimit.get_limiter().acquire(chat_id)
+            response = self.session.request(method, url, params=params, files=files, proxies=proxies,
+                                            timeout=timeout or (self.connect_timeout, self.read_timeout), **kwargs)
+            if response.status_code != 429 or not self.installed:
+                return response
+            if not self.schedule_retry(response, chat_id, limited, attempt, retryable=not files):
+                return response
+            attempt += 1
+
+    @staticmethod
+    def schedule_retry(response, chat_id, limited, attempt, retryable=True):
+        """
+        Handle a 429: pause the throttled lane for `retry_after` and tell whether the call should be sent again.
+        Interactive calls give up instead of holding their worker longer than RETRY_429_MAX_WAIT
+        """
+        try:
+            retry_after = float(response.json()['parameters']['retry_after'])
+        except (ValueError, KeyError, TypeError):
+            retry_after = 1.
+        broadcast = ratelimit.current_lane() == ratelimit.Lane.BROADCAST
+        metrics.incr('transport.throttled')
+        metrics.incr('transport.retry_after', retry_after)
+        if settings.RATE_LIMIT_ENABLED:
+            ratelimit.get_limiter().pause(None if broadcast or chat_id is None else chat_id, retry_after)
+        if not retryable or attempt >= settings.RETRY_429_ATTEMPTS or (not broadcast and retry_after > settings.RETRY_429_MAX_WAIT):
+            metrics.incr('transport.gave_up')
+            return False
+        if not limited:
+            time.sleep(retry_after)
+        metrics.incr('transport.retried')
+        return True
+
+    def install(self):
+        """
+        Route every telebot Bot API call of this process through this transport
+        """
+        self.installed = True
+        apihelper.CUSTOM_REQUEST_SENDER = self.request
+        apihelper.session = self.session
+        apihelper.CONNECT_TIMEOUT = self.connect_timeout
+        apihelper.READ_TIMEOUT = self.read_timeout
+        if settings.TELEGRAM_API_URL:
+            apihelper.API_URL = settings.TELEGRAM_API_URL
+        return self
+
+
+transport = Transport()
+os.register_at_fork(after_in_child=transport.reset)
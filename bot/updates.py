@@ -0,0 +1,134 @@
+import re
+from telebot import types, apihelper
+from bot.utils_lib import json
+
+UPDATE_TYPES = {
+    'message': types.Message,
+    'edited_message': types.Message,
+    'channel_post': types.Message,
+    'edited_channel_post': types.Message,
+    'inline_query': types.InlineQuery,
+    'chosen_inline_result': types.ChosenInlineResult,
+    'callback_query': types.CallbackQuery,
+    'shipping_query': types.ShippingQuery,
+    'pre_checkout_query': types.PreCheckoutQuery,
+    'poll': types.Poll,
+    'poll_answer': types.PollAnswer,
+    'my_chat_member': types.ChatMemberUpdated,
+    'chat_member': types.ChatMemberUpdated,
+    'chat_join_request': types.ChatJoinRequest,
+}
+# TeleBot method handling a list of payloads of each type
+HANDLERS = {
+    'message': 'process_new_messages',
+    'edited_message': 'process_new_edited_messages',
+    'channel_post': 'process_new_channel_posts',
+    'edited_channel_post': 'process_new_edited_channel_posts',
+    'inline_query': 'process_new_inline_query',
+    'chosen_inline_result': 'process_new_chosen_inline_query',
+    'callback_query': 'process_new_callback_query',
+    'shipping_query': 'process_new_shipping_query',
+    'pre_checkout_query': 'process_new_pre_checkout_query',
+    'poll': 'process_new_poll',
+    'poll_answer': 'process_new_poll_answer',
+    'my_chat_member': 'process_new_my_chat_member',
+    'chat_member': 'process_new_chat_member',
+    'chat_join_request': 'process_new_chat_join_request',
+}
+
+
+# "from" of the update payload itself, preceded only by scalar fields: a nested object
+# (reply_to_message, the message of a callback...) may carry the "from" of another user
+SCALAR = rb'(?:"(?:[^"\\]|\\.)*"|-?[\d.eE+-]+|true|false|null)'
+FROM_ID = re.compile(rb'\s*\{\s*"update_id"\s*:\s*\d+\s*,\s*"(?:' + b'|'.join(x.encode() for x in UPDATE_TYPES) +
+                     rb')"\s*:\s*\{\s*(?:"\w+"\s*:\s*' + SCALAR + rb'\s*,\s*)*"from"\s*:\s*\{\s*"id"\s*:\s*(-?\d+)')
+
+
+def peek_user_id(body: bytes):
+    """
+    UpdateView.user_id of a raw update: read from its first bytes when the sender comes first
+    in its payload, as Telegram serializes it, and from the parsed update otherwise
+    """
+    match = FROM_ID.match(body)
+    if match:
+        return int(match.group(1))
+    try:
+        return UpdateView.parse(body).user_id
+    except ValueError:
+        return
+
+
+def dispatch(bot, view: 'UpdateView'):
+    """
+    Hand an update to the TeleBot handlers of its type only: process_new_updates checks every update
+    type and builds the whole Update first. Updates go through it when middlewares are enabled
+    """
+    if apihelper.ENABLE_MIDDLEWARE:
+        bot.process_new_updates([view.update])
+        return
+    if view.update_id is not None and view.update_id > bot.last_update_id:
+        bot.last_update_id = view.update_id
+    if view.kind is not None:
+        getattr(bot, HANDLERS[view.kind])([UPDATE_TYPES[view.kind].de_json(view.payload)])
+
+
+class UpdateView:
+    """
+    Lightweight read-only view of a raw update, parsed once.
+
+    Exposes the few fields routing needs (IDs, text, callback data) straight from the decoded JSON,
+    `dispatch` only builds the telebot object of the payload.
+    """
+    __slots__ = ('data', 'update_id', 'kind', 'payload', '_update')
+
+    def __init__(self, data: dict):
+        self.data = data
+        self.update_id = data.get('update_id')
+        self.kind = self.payload = None
+        for kind in UPDATE_TYPES:
+            payload = data.get(kind)
+            if payload:
+                self.kind, self.payload = kind, payload
+                break
+        self._update = None
+
+    @classmethod
+    def parse(cls, body):
+        data = json.loads(body) if isinstance(body, (bytes, str)) else body
+        if not isinstance(data, dict):
+            raise ValueError('Update must be a JSON object')
+        return cls(data)
+
+    @property
+    def user_id(self):
+        if self.payload is None:
+            return
+        return (self.payload.get('from') or self.payload.get('user') or self.payload.get('chat') or {}).get('id')
+
+    @property
+    def message(self) -> dict:
+        if self.kind == 'callback_query':
+            return self.payload.get('message') or {}
+        return self.payload if self.payload is not None and 'message_id' in self.payload else {}
+
+    @property
+    def chat_id(self):
+        return (self.message.get('chat') or {}).get('id')
+
+    @property
+    def message_id(self):
+        return self.message.get('message_id')
+
+    @property
+    def text(self):
+        return self.payload.get('text') if self.kind == 'message' else None
+
+    @property
+    def callback_data(self):
+        return self.payload.get('data') if self.kind == 'callback_query' else None
+
+    @property
+    def update(self) -> types.Update:
+        if self._update is None:
+            self._update = types.Update.de_json(self.data)
+        return self._update
@@ -1,13 +1,16 @@
 import json
+import threading
 import traceback
-import requests
+from collections import OrderedDict
 from contextlib import suppress
 from django.conf import settings
-from preferences import preferences
+from bot.prefs import preferences
 from telebot.types import ReplyKeyboardMarkup as RKM, InlineKeyboardMarkup as IKM
-from telebot.types import KeyboardButton, ReplyKeyboardRemove, InlineKeyboardButton, CallbackQuery
+from telebot.types import KeyboardButton, ReplyKeyboardRemove, InlineKeyboardButton, CallbackQuery, JsonSerializable
 from telebot.apihelper import ApiTelegramException
-from bot import models, misc
+from bot import models, misc, inline, ratelimit, logwriter, metrics
+from bot.transport import transport
+from bot.cache import user_cache
 from bot.utils_lib import helper, callback_data
 from bot.types import Order
 
@@ -59,6 +62,14 @@ class ButtonSet(helper.Helper):
     INL_ORDER_HISTORY_ORDER = helper.Item()
 
     def __new__(cls, btn_set: helper.Item = None, args=None, row_width=1):
+        if btn_set in (cls.START, cls.INL_ORDERS, cls.INL_HELP, cls.INL_QUESTION, cls.INL_ORDER_HISTORY_ORDER):
+            return keyboards.static(btn_set, row_width)
+        if btn_set in DYNAMIC_KEYBOARDS:
+            return keyboards.dynamic(btn_set, args, row_width)
+        return cls.build(btn_set, args, row_width)
+
+    @classmethod
+    def build(cls, btn_set: helper.Item = None, args=None, row_width=1):
         if btn_set == cls.REMOVE:
             return ReplyKeyboardRemove()
         key = ReplyKeyboardMarkup(resize_keyboard=True, row_width=row_width)
@@ -95,14 +106,105 @@ class ButtonSet(helper.Helper):
         return key or ikey
 
 
+# keyboards of (callback function of the buttons built from args, (Texts label, callback function) of the last row)
+DYNAMIC_KEYBOARDS = {
+    ButtonSet.INL_ORDER_SHOPS: (CallbackFuncs.ORDER_SHOP, None),
+    ButtonSet.INL_ORDER_HISTORY: (CallbackFuncs.ORDER_HISTORY_INFO, ('btn_back', CallbackFuncs.ORDERS)),
+    ButtonSet.INL_SHOPS: (CallbackFuncs.SHOP_INFO, None),
+    ButtonSet.INL_FAQ: (CallbackFuncs.FAQ_QUESTION, ('btn_back', CallbackFuncs.HELP)),
+}
+
+
+class PreparedMarkup(JsonSerializable):
+    """
+    Keyboard serialized in advance
+    """
+
+    def __init__(self, json_: str):
+        self.json = json_
+
+    def to_json(self):
+        return self.json
+
+    def __bool__(self):
+        return bool(self.json)
+
+
+class Keyboards:
+    """
+    Static ButtonSet keyboards serialized once per preferences version. Dynamic ones are joined
+    from an LRU of serialized buttons, so a shop or order already shown costs no set_callback/json.dumps
+    """
+
+    def __init__(self, size=None):
+        self.size = size or settings.KEYBOARD_FRAGMENTS_SIZE
+        self.lock = threading.Lock()
+        self.version = None
+        self.prepared = {}
+        self.fragments = OrderedDict()
+        metrics.register('keyboards', lambda: {'prepared': len(self.prepared), 'fragments': len(self.fragments)})
+
+    def static(self, btn_set, row_width=1) -> PreparedMarkup:
+        version = preferences.Texts.version
+        prepared = self.prepared
+        if version != self.version or (btn_set, row_width) not in prepared:
+            markup = ButtonSet.build(btn_set, row_width=row_width)
+            with self.lock:
+                if version != self.version:
+                    self.prepared, self.version = {}, version
+                self.prepared = {**self.prepared, (btn_set, row_width): PreparedMarkup(markup.to_json())}
+                prepared = self.prepared
+        return prepared[(btn_set, row_width)]
+
+    def button(self, text, func, data=None) -> str:
+        """
+        Serialized button
+        """
+        key = (text, func, data)
+        with self.lock:
+            fragment = self.fragments.get(key)
+            if fragment is not None:
+                self.fragments.move_to_end(key)
+                return fragment
+        fragment = json.dumps({'text': text, 'callback_data': set_callback(func, data)})
+        with self.lock:
+            self.fragments[key] = fragment
+            if len(self.fragments) > self.size:
+                self.fragments.popitem(last=False)
+        return fragment
+
+    def dynamic(self, btn_set, args, row_width=1):
+        func, last = DYNAMIC_KEYBOARDS[btn_set]
+        buttons = [self.button(text, func, data) for text, data in args or ()]
+        rows = [buttons[i:i + row_width] for i in range(0, len(buttons), row_width)]
+        if last is not None:
+            rows.append([self.button(getattr(preferences.Texts, last[0]), last[1])])
+        if not rows:
+            # falsy, so telebot omits it like an empty InlineKeyboardMarkup
+            return PreparedMarkup('')
+        return PreparedMarkup('{"inline_keyboard": [%s]}' % ', '.join('[%s]' % ', '.join(row) for row in rows))
+
+
+keyboards = Keyboards()
+
+
 def answer(message, text, reply_markup=None, pm=True, **kwargs):
     def send_message(func, _type, *types, **kw):
         for t in types:
             if kwargs.get(t):
                 del kwargs[t]
+        if _type is None and text and (not pm or inline.is_valid_html(text)):
+            params = dict(chat_id=message.chat.id, reply_markup=reply_markup, parse_mode='HTML' if pm else None, **kwargs, **kw)
+            if inline.offer('sendMessage', params, lambda: func(**params)):
+                if settings.RATE_LIMIT_ENABLED:
+                    ratelimit.get_limiter().acquire(message.chat.id)
+                return
         try:
             func(message.chat.id, reply_markup=reply_markup, parse_mode='HTML' if pm else None, **kwargs, **kw)
-        except ApiTelegramException:
+        except ApiTelegramException as e:
+            # resending as plain text would only add to a flood
+            if e.error_code == 429:
+                raise
             del kwargs[_type]
             misc.bot.send_message(message.chat.id, text, parse_mode='HTML' if pm else None, **kwargs, **kw)
     if text == '-':
@@ -119,19 +221,22 @@ def answer(message, text, reply_markup=None, pm=True, **kwargs):
 
 def user_handler(function):
     def decorator(message, **kwargs):
-        user, created = models.User.objects.get_or_create(
-                                       user_id=message.from_user.id,
-                                       defaults={'user_id': message.from_user.id,
-                                                 'username': message.from_user.username,
-                                                 'first_name': message.from_user.first_name,
-                                                 'last_name': message.from_user.last_name})
+        (user, version), created = user_cache.get(message.from_user.id), False
+        if user is None:
+            user, created = models.User.objects.get_or_create(
+                                           user_id=message.from_user.id,
+                                           defaults={'user_id': message.from_user.id,
+                                                     'username': message.from_user.username,
+                                                     'first_name': message.from_user.first_name,
+                                                     'last_name': message.from_user.last_name})
+            user_cache.put(user, version)
         if not created:
             if user.is_banned:
                 return
             user.username = message.from_user.username
             user.first_name = message.from_user.first_name
             user.last_name = message.from_user.last_name
-            user.save()
+            user.save_dirty()
         kwargs['user'] = user
         # kwargs['created'] = created
         if function.__name__ == 'decorator':
@@ -152,14 +257,27 @@ def logger_middleware(type_, content=None, is_callback=False):
                 button = None
                 if is_callback:
                     callback = get_instance(args, CallbackQuery)
-                    key = callback.message.reply_markup.to_dict()['inline_keyboard']
-                    button = [res[0] for res in [[button['text'] for button in row if button.get('callback_data') == callback.data] for row in key] if res][0]
-                models.Log.objects.create(user=user, type=type_, content=content or button or message.text)
+                    button = button_label(callback)
+                logwriter.write(models.Log(user=user, type=type_, content=content or button or message.text))
             return function(message, *args, **kwargs)
         return decorator
     return wrapper
 
 
+def button_label(callback: CallbackQuery):
+    """
+    Text of the pressed button. The keyboard of the message comes already parsed with the update and is
+    the only reliable source, as several keyboards reuse a callback_data (FAQ and Back to FAQ...)
+    """
+    markup = callback.message.reply_markup if callback.message else None
+    if markup is None:
+        return None
+    for row in markup.keyboard:
+        for button in row:
+            if button.callback_data == callback.data:
+                return button.text
+
+
 def reset_state_checker(function):
     def decorator(message, *args, **kwargs):
         user = get_instance(args, models.User)
@@ -246,5 +364,5 @@ def create_invoice(amount, order_id):
         'x-api-key': preferences.Settings.payment_api_key,
         'Content-Type': 'application/json'
     }
-    response = requests.post(url, headers=headers, data=payload)
+    response = transport.session.post(url, headers=headers, data=payload, timeout=(transport.connect_timeout, transport.read_timeout))
     return response.json().get('invoice_url')
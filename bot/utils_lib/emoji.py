@@ -5,7 +5,11 @@ except ImportError:
 
 
 def emojize(text):
-    return emoji.emojize(text, use_aliases=True)
+    try:
+        return emoji.emojize(text, language='alias')
+    except (TypeError, KeyError):
+        # emoji < 1.7: no 'alias' language, and use_aliases was removed in 2.0
+        return emoji.emojize(text, use_aliases=True)
 
 
 def demojize(text):
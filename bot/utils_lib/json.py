@@ -2,12 +2,13 @@ import importlib
 import os
 
 JSON = 'json'
+ORJSON = 'orjson'
 RAPIDJSON = 'rapidjson'
 UJSON = 'ujson'
 
 # Detect mode
 mode = JSON
-for json_lib in (RAPIDJSON, UJSON):
+for json_lib in (ORJSON, RAPIDJSON, UJSON):
     if 'DISABLE_' + json_lib.upper() in os.environ:
         continue
 
@@ -19,7 +20,15 @@ for json_lib in (RAPIDJSON, UJSON):
         mode = json_lib
         break
 
-if mode == RAPIDJSON:
+if mode == ORJSON:
+    def dumps(data):
+        return json.dumps(data).decode()
+
+
+    def loads(data):
+        return json.loads(data)
+
+elif mode == RAPIDJSON:
     def dumps(data):
         return json.dumps(data, ensure_ascii=False)
 
@@ -0,0 +1,34 @@
+import time
+from django.conf import settings
+from bot import storage
+
+
+class VersionStamp:
+    """
+    Counter shared by all processes through the runtime SQLite file, bumped whenever the data it stamps changes.
+    Readers re-check it at most every VERSION_CHECK_INTERVAL seconds.
+    """
+
+    def __init__(self, name, path=None):
+        self.name = name
+        self.path = path or settings.RUNTIME_DB_PATH
+        self.value = None
+        self.checked = 0.
+        self.connection.execute('CREATE TABLE IF NOT EXISTS versions (name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+
+    @property
+    def connection(self):
+        return storage.connect(self.path)
+
+    def bump(self):
+        self.connection.execute('INSERT INTO versions (name, value) VALUES (?, 1) '
+                                'ON CONFLICT (name) DO UPDATE SET value = value + 1', (self.name,))
+        self.checked = 0.
+
+    def get(self):
+        now = time.monotonic()
+        if now - self.checked >= settings.VERSION_CHECK_INTERVAL:
+            row = self.connection.execute('SELECT value FROM versions WHERE name = ?', (self.name,)).fetchone()
+            self.value = row[0] if row else 0
+            self.checked = now
+        return self.value
@@ -1,34 +1,96 @@
-from contextlib import suppress
-from json import decoder
+from contextlib import suppress, nullcontext
 
+import os
 import traceback
+from functools import wraps
 
-from preferences import preferences
+from bot.prefs import preferences
 from django.conf import settings
-from django.http import HttpResponse
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse, JsonResponse
+from django.core.exceptions import ImproperlyConfigured
 from django.views.decorators.csrf import csrf_exempt
 from bot.handlers import bot
 from bot.utils import exec_protected
+from bot.ingress import UpdateQueue
+from bot.dedup import get_deduplicator
+from bot.bans import banlist
+from bot.updates import UpdateView, dispatch, peek_user_id
 from bot.types import Order
-from bot import models
-from telebot.types import Update
+from bot import models, inline, metrics
+
+
+def check_settings():
+    """
+    The async view acknowledges updates before they are handled: only the durable queue may hold them
+    """
+    if settings.WEBHOOK_ASYNC and not settings.WEBHOOK_QUEUE:
+        raise ImproperlyConfigured('WEBHOOK_ASYNC requires WEBHOOK_QUEUE: updates acknowledged by the async view '
+                                   'would be lost on restart')
+
+
+check_settings()
+update_queue = UpdateQueue() if settings.WEBHOOK_QUEUE else None
+
+
+def enqueue(body):
+    """
+    Queue the raw update for the consumers, its user ID is read without parsing it
+    """
+    user_id = peek_user_id(body)
+    if not banlist.is_banned(user_id):
+        update_queue.put(body, user_id)
+    return HttpResponse()
+
+
+def async_csrf_exempt(view):
+    """
+    csrf_exempt for coroutine views: the decorator of this Django version wraps them in a sync function
+    """
+    @wraps(view)
+    async def wrapped_view(*args, **kwargs):
+        return await view(*args, **kwargs)
+    wrapped_view.csrf_exempt = True
+    return wrapped_view
 
 
 @csrf_exempt
 def update(request):
+    metrics.start_publisher(f'web-{os.getpid()}')
+    if update_queue is not None:
+        return enqueue(request.body)
     try:
-        update_json = Update.de_json(request.body.decode())
-    except decoder.JSONDecodeError:
+        view = UpdateView.parse(request.body)
+    except ValueError:
         return HttpResponse(b'JSON decode error', status=400)
-    # noinspection PyBroadException
-    try:
-        bot.process_new_updates([update_json])
-    except Exception:
-        with suppress(Exception):
-            bot.send_message(settings.DEVS[0], traceback.format_exc())
+    if banlist.is_banned(view.user_id):
+        return HttpResponse()
+    if settings.DEDUP_UPDATES and get_deduplicator().seen(view.update_id):
+        return HttpResponse()
+    with inline.capture() if settings.WEBHOOK_INLINE_REPLY else nullcontext() as slot:
+        # noinspection PyBroadException
+        try:
+            dispatch(bot, view)
+        except Exception:
+            with suppress(Exception):
+                bot.send_message(settings.DEVS[0], traceback.format_exc())
+    if slot is not None and slot.reply is not None:
+        return JsonResponse(slot.reply)
     return HttpResponse()
 
 
+@async_csrf_exempt
+async def update_async(request):
+    """
+    Append the update to the queue without blocking the event loop on handlers: the consumers
+    (daemons/consumer.py, manage.py startbot --supervise) handle it
+    """
+    metrics.start_publisher(f'web-{os.getpid()}')
+    if banlist.is_stale():
+        await sync_to_async(banlist.refresh, thread_sensitive=False)()
+    return enqueue(request.body)
+
+
 def handle_payment(request):
     order_id = int(request.POST.get('order_id'))
     try:
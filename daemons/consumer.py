@@ -0,0 +1,32 @@
+from os import environ
+from threading import Thread, Event
+from time import sleep
+from django import setup
+
+
+def main():
+    consumer = Consumer(UpdateQueue())
+    stop = Event()
+    thread = Thread(target=consumer.run, args=(stop,), daemon=True)
+    thread.start()
+    try:
+        while thread.is_alive():
+            metrics.publish('consumer')
+            sleep(settings.METRICS_INTERVAL)
+    except KeyboardInterrupt:
+        pass
+    stop.set()
+    thread.join()
+    log_writer.stop()
+
+
+if __name__ == '__main__':
+    import sys
+    sys.path.append('.')
+    environ.setdefault('DJANGO_SETTINGS_MODULE', 'app.settings')
+    setup()
+    from django.conf import settings
+    from bot import metrics
+    from bot.ingress import UpdateQueue, Consumer
+    from bot.logwriter import log_writer
+    main()
@@ -1,9 +1,20 @@
 from os import environ
-from time import sleep
+from time import time
+from signal import signal, SIGTERM
+from threading import Event
 from contextlib import suppress
 from django import setup
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
 
+# shared with the supervisor when run by bot.supervisor.run_sender
+heartbeat = globals().get('heartbeat')
+stopping = Event()
+
+
+def beat():
+    if heartbeat is not None:
+        heartbeat.value = time()
+
 
 def send_post(post, user):
     key = None
@@ -29,11 +40,13 @@ def process_post(post):
     users = [user.user_id for user in users]
 
     receivers = 0
-    for user in users:
-        with suppress(Exception):
-            send_post(post, user)
-            receivers += 1
-        sleep(.05)
+    # paced by the shared rate limiter, behind interactive replies
+    with lane(Lane.BROADCAST):
+        for user in users:
+            with suppress(Exception):
+                send_post(post, user)
+                receivers += 1
+            beat()
 
     post.refresh_from_db()
     post.status = Post.DONE
@@ -42,11 +55,17 @@ def process_post(post):
 
 
 def main():
-    while True:
+    # on SIGTERM the post being sent is finished, the next ones wait for the restart
+    signal(SIGTERM, lambda *args: stopping.set())
+    metrics.start_publisher('sender')
+    while not stopping.is_set():
+        beat()
         with suppress(Exception):
             for post in models.Post.objects.filter(status=Post.WAIT).order_by('created'):
                 process_post(post)
-        sleep(5)
+                if stopping.is_set():
+                    break
+        stopping.wait(5)
 
 
 if __name__ == '__main__':
@@ -54,7 +73,8 @@ if __name__ == '__main__':
     sys.path.append('.')
     environ.setdefault('DJANGO_SETTINGS_MODULE', 'app.settings')
     setup()
-    from bot import models
+    from bot import models, metrics
     from bot.misc import bot
     from bot.types import Post
+    from bot.ratelimit import lane, Lane
     main()